@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import datetime
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_connection
+
+from lutefisk.tokens import get_timestamp
+from lutefisk.utils import get_datetime_now
+
+logger = logging.getLogger('lutefisk.activity')
+
+
+class ActivityBuffer(object):
+    """
+    Collects user activity in memory and writes it to
+    ``LutefiskSignup.last_active`` in bulk.
+
+    A user is recorded at most once per ``LUTEFISK_LAST_ACTIVE_INTERVAL``
+    seconds; the cache remembers who was recorded recently, so with a
+    shared cache this holds across processes. Timestamps are rounded down
+    to the interval, which lets :func:`flush` write all users of the same
+    interval with a single ``UPDATE`` per batch.
+
+    Pending activity is written by the middleware, by a background timer
+    ``LUTEFISK_LAST_ACTIVE_FLUSH_SECONDS`` after it was recorded, even if
+    no more requests come in, and when the process exits. A process that
+    is killed without exiting normally loses at most the activity of the
+    last ``LUTEFISK_LAST_ACTIVE_FLUSH_SECONDS``.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = time.time()
+        self.timer = None
+
+    def touch(self, user_id):
+        """
+        Records that a user is active.
+
+        :param user_id:
+        The primary key of the :class:`User`.
+
+        :return: ``True`` if the activity was recorded.
+
+        """
+        interval = settings.LUTEFISK_LAST_ACTIVE_INTERVAL
+        if not cache.add('lutefisk:last-active:%s' % user_id, 1, interval):
+            return False
+
+        now = get_datetime_now()
+        now -= datetime.timedelta(seconds=get_timestamp(now) % interval,
+                                  microseconds=now.microsecond)
+
+        self.lock.acquire()
+        try:
+            self.pending[user_id] = now
+            if self.timer is None:
+                self.start_timer()
+        finally:
+            self.lock.release()
+        return True
+
+    def start_timer(self):
+        """
+        Schedules :meth:`flush_pending` on a background thread. Called with
+        the lock held.
+
+        """
+        self.timer = threading.Timer(settings.LUTEFISK_LAST_ACTIVE_FLUSH_SECONDS,
+                                     self.flush_pending)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def should_flush(self):
+        """
+        Returns ``True`` when ``LUTEFISK_LAST_ACTIVE_BATCH_SIZE`` users are
+        pending or the last flush is ``LUTEFISK_LAST_ACTIVE_FLUSH_SECONDS``
+        ago.
+
+        """
+        if not self.pending:
+            return False
+        return (len(self.pending) >= settings.LUTEFISK_LAST_ACTIVE_BATCH_SIZE or
+                time.time() - self.last_flush >= settings.LUTEFISK_LAST_ACTIVE_FLUSH_SECONDS)
+
+    def flush(self):
+        """
+        Writes the pending activity to the database.
+
+        :return: The number of users that were updated.
+
+        """
+        from lutefisk.models import LutefiskSignup
+
+        self.lock.acquire()
+        try:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.time()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        finally:
+            self.lock.release()
+
+        user_ids = {}
+        for user_id, last_active in pending.items():
+            user_ids.setdefault(last_active, []).append(user_id)
+
+        batch_size = settings.LUTEFISK_LAST_ACTIVE_BATCH_SIZE
+        for last_active, ids in user_ids.items():
+            for start in range(0, len(ids), batch_size):
+                LutefiskSignup.objects.filter(user__in=ids[start:start + batch_size]) \
+                    .update(last_active=last_active)
+        return len(pending)
+
+    def flush_pending(self):
+        """
+        Flushes outside of a request, from the timer and at exit. Errors are
+        logged instead of raised.
+
+        """
+        if not self.pending:
+            return
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Writing the last activity failed.')
+        finally:
+            close_connection()
+
+activity_buffer = ActivityBuffer()
+atexit.register(activity_buffer.flush_pending)
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.hashcompat import sha_constructor
+from django.utils.http import int_to_base36
+from django.utils.importlib import import_module
+
+_allocator = None
+
+
+class UsernameAllocator(object):
+    """
+    Base class for the username allocators used by :class:`SignupForm`.
+
+    Users sign in with their email address so lutefisk generates the
+    usernames. Set ``LUTEFISK_USERNAME_ALLOCATOR`` to the dotted path of a
+    subclass to change how they are generated.
+
+    """
+    def allocate(self):
+        """
+        Returns a username that is not in use yet.
+
+        :return: String containing the new username.
+
+        """
+        raise NotImplementedError
+
+
+class RandomUsernameAllocator(UsernameAllocator):
+    """
+    Picks random five character usernames until a free one is found.
+
+    This was the original lutefisk behaviour. Every attempt costs a query
+    and the number of attempts grows with the number of users, so it is
+    only kept for sites that depend on the old username format.
+
+    """
+    def allocate(self):
+        while True:
+            username = sha_constructor(str(random.random())).hexdigest()[:5]
+            try:
+                User.objects.get(username__iexact=username)
+            except User.DoesNotExist:
+                return username
+
+
+class SequenceUsernameAllocator(UsernameAllocator):
+    """
+    Hands out usernames from a database sequence.
+
+    Numbers are reserved in blocks of ``LUTEFISK_USERNAME_BLOCK_SIZE`` so
+    that most signups don't need a query at all, and are encoded in base
+    36 after ``LUTEFISK_USERNAME_PREFIX``. The prefix is not a hexadecimal
+    character so the usernames never collide with those of
+    :class:`RandomUsernameAllocator`. Tens of millions of users fit in
+    six characters.
+
+    """
+    sequence_name = 'username'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next, self.last = 1, 0
+
+    def allocate(self):
+        from lutefisk.models import LutefiskSequence
+
+        self.lock.acquire()
+        try:
+            if self.next > self.last:
+                self.next, self.last = LutefiskSequence.objects.reserve(self.sequence_name,
+                                                                        settings.LUTEFISK_USERNAME_BLOCK_SIZE)
+            number = self.next
+            self.next += 1
+        finally:
+            self.lock.release()
+        return settings.LUTEFISK_USERNAME_PREFIX + int_to_base36(number)
+
+
+def load_username_allocator(path):
+    """
+    Instantiates the username allocator class with the dotted ``path``.
+
+    """
+    module_name, class_name = path.rsplit('.', 1)
+    try:
+        allocator_class = getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured('Error loading username allocator %s: "%s"' % (path, e))
+    return allocator_class()
+
+
+def get_username_allocator():
+    """
+    Returns the username allocator defined by ``LUTEFISK_USERNAME_ALLOCATOR``.
+
+    The allocator is created once per process so that reserved blocks are
+    shared by all requests.
+
+    """
+    global _allocator
+    if _allocator is None:
+        _allocator = load_username_allocator(settings.LUTEFISK_USERNAME_ALLOCATOR)
+    return _allocator
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 
+from django.conf import settings
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.validators import email_re
 
+from lutefisk import instrumentation
+from lutefisk import routers
+from lutefisk import signals
+from lutefisk.models import LutefiskSignup
+from lutefisk.utils import CachedUser, normalize_identification, get_user_cache_key, \
+    get_user_version
+
 
 class LutefiskAuthenticationBackend(ModelBackend):
     """
@@ -16,6 +25,11 @@ class LutefiskAuthenticationBackend(ModelBackend):
         Authenticates a user through the combination email/username with
         password.
 
+        The user is looked up through the normalized identification columns
+        of :class:`LutefiskSignup`, which are uniquely indexed, instead of a
+        case-insensitive scan of the user table. Every user has a signup
+        with these columns filled in, see :func:`sync_identification`.
+
         :param identification:
         A string containing the username or e-mail of the user that is
         trying to authenticate.
@@ -28,27 +42,88 @@ class LutefiskAuthenticationBackend(ModelBackend):
         user.  Always keep this ``True``. This is only used by lutefisk at
         activation when a user opens a page with a secret hash.
 
+        Every password check sends the ``password_checked`` signal, which
+        can be used to count the password hashes computed per request.
+
         :return: The signed in :class:`User`.
 
         """
+        normalized = normalize_identification(identification)
+        if not normalized:
+            return None
         if email_re.search(identification):
-            try:
-                user = User.objects.get(email__iexact=identification)
-            except User.DoesNotExist:
-                return None
+            field = 'email'
         else:
-            try:
-                user = User.objects.get(username__iexact=identification)
-            except User.DoesNotExist:
-                return None
+            field = 'username'
+
+        try:
+            signup = LutefiskSignup.objects.select_related('user') \
+                .get(**{'%s_lower' % field: normalized})
+        except LutefiskSignup.DoesNotExist:
+            return None
+        user = signup.user
+        # The signup is out of date when the user was changed with a
+        # queryset update, which sends no signals.
+        if normalize_identification(getattr(user, field)) != normalized:
+            return None
+        user._lutefisk_signup_cache = signup
         if check_password:
-            if user.check_password(password):
+            with instrumentation.timer('hash'):
+                valid = user.check_password(password)
+            signals.password_checked.send(sender=self.__class__, user=user, valid=valid)
+            if valid:
                 return user
             return None
         else:
             return user
 
     def get_user(self, user_id):
+        """
+        Returns the user with the primary key ``user_id``.
+
+        With ``LUTEFISK_USER_CACHE`` the user is kept in the cache for
+        ``LUTEFISK_USER_CACHE_TIMEOUT`` seconds, so signed in requests
+        normally don't query the user table. The key contains a version
+        per user that is incremented whenever the user is saved or deleted,
+        see :func:`forget_cached_user`. The password hash is not cached; a
+        cached user loads it from the database when it is used. The cache
+        is only filled from the primary, because a lagging replica could
+        put back a user that was just changed.
+
+        Without the cache the user is read from a replica when
+        ``LUTEFISK_READ_REPLICAS`` are configured, and from the primary if
+        the replica doesn't have it yet.
+
+        :return: The :class:`User` or ``None`` if it doesn't exist.
+
+        """
+        if settings.LUTEFISK_USER_CACHE:
+            # The version is read before the user, so a user loaded before
+            # a change is stored under a version that is no longer used.
+            key = get_user_cache_key(user_id, get_user_version(user_id))
+            cached = cache.get(key)
+            if cached is not None:
+                db, values = cached
+                user = CachedUser(**values)
+                user._state.db = db
+                return user
+            try:
+                with routers.primary():
+                    user = User.objects.get(pk=user_id)
+            except User.DoesNotExist:
+                return None
+            values = dict((field.attname, getattr(user, field.attname))
+                          for field in User._meta.fields if field.attname != 'password')
+            cache.set(key, (user._state.db, values), settings.LUTEFISK_USER_CACHE_TIMEOUT)
+            return user
+
+        try:
+            with routers.replica():
+                return User.objects.get(pk=user_id)
+        except User.DoesNotExist:
+            if not settings.LUTEFISK_READ_REPLICAS:
+                return None
+        # The replica may not have the user yet.
         try:
             return User.objects.get(pk=user_id)
         except User.DoesNotExist:
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import time
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User, AnonymousUser
+from django.core.signals import request_started
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction, reset_queries
+from django.test.client import Client
+
+from lutefisk.models import LutefiskSignup
+from lutefisk import allocators
+from lutefisk import signals
+from lutefisk import utils
+
+SEED_PASSWORD = 'password'
+
+FLOWS = ('signup', 'create_user', 'signin', 'activate', 'change_email',
+         'confirm_email', 'email_change_confirm', 'visible_profiles',
+         'delete_expired_users')
+
+# Maximum number of queries and password hashes per call. Flows over
+# budget make the benchmark command fail.
+QUERY_BUDGETS = {'create_user': 4}
+HASH_BUDGETS = {'signin': 1}
+
+
+class QueryCounter(object):
+    """
+    Counts the SQL queries executed on the default connection.
+
+    Use as a context manager; the number of queries is available as
+    ``count`` afterwards. ``writes`` holds the number of ``INSERT``,
+    ``UPDATE`` and ``DELETE`` statements and ``write_bytes`` the length of
+    their SQL, a measure of the number of columns they write. ``hashes``
+    holds the number of password checks, counted with the
+    ``password_checked`` signal.
+
+    """
+    def __enter__(self):
+        # Requests made with the test client would reset the queries.
+        request_started.disconnect(reset_queries)
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        self.count = self.writes = self.write_bytes = self.hashes = 0
+        signals.password_checked.connect(self.count_hash)
+        return self
+
+    def count_hash(self, sender, **kwargs):
+        self.hashes += 1
+
+    def __exit__(self, *args):
+        signals.password_checked.disconnect(self.count_hash)
+        queries = connection.queries[self.start:]
+        self.count = len(queries)
+        for query in queries:
+            if query['sql'].lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+                self.writes += 1
+                self.write_bytes += len(query['sql'])
+        connection.use_debug_cursor = self.use_debug_cursor
+        reset_queries()
+        request_started.connect(reset_queries)
+
+
+def setup_database(verbosity=0):
+    """
+    Creates and migrates a throw-away test database.
+
+    :return: The name of the original database to pass to
+    :func:`teardown_database`.
+
+    """
+    try:
+        from south.management.commands import patch_for_test_db_setup
+        patch_for_test_db_setup()
+    except ImportError:
+        pass
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True)
+
+    # Keep the emails in memory like the test runner does.
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    return old_name
+
+
+def teardown_database(old_name, verbosity=0):
+    """ Destroys the database created by :func:`setup_database`. """
+    connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+
+def _insert_select(model, values, min_user_id):
+    """
+    Inserts one ``model`` row for every user with a primary key above
+    ``min_user_id`` with a single ``INSERT ... SELECT``.
+
+    Fields that are missing from ``values`` get their default value.
+
+    """
+    qn = connection.ops.quote_name
+    columns, selects, params = [], [], []
+    for field in model._meta.local_fields:
+        if field.primary_key:
+            continue
+        columns.append(qn(field.column))
+        if field.name == 'user':
+            selects.append(qn('id'))
+        elif field.name in values:
+            selects.append(values[field.name])
+        else:
+            selects.append('%s')
+            params.append(field.get_db_prep_save(field.get_default(), connection=connection))
+
+    sql = 'INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s > %%s' % \
+        (qn(model._meta.db_table), ', '.join(columns), ', '.join(selects),
+         qn(User._meta.db_table), qn('id'))
+    connection.cursor().execute(sql, params + [min_user_id])
+
+
+def seed_users(count, batch_size=10000, active=True, date_joined=None):
+    """
+    Quickly adds ``count`` users with signups and profiles.
+
+    Usernames are legacy five character hexadecimal strings while they
+    fit, so that the random allocator sees a realistic collision rate. All
+    users share the password ``SEED_PASSWORD``.
+
+    :return: The number of users in the database.
+
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+
+    offset = User.objects.count()
+    last_id = User.objects.order_by('-pk').values_list('pk', flat=True)[:1]
+    last_id = last_id and last_id[0] or 0
+    now = connection.ops.value_to_db_datetime(utils.get_datetime_now())
+    joined = connection.ops.value_to_db_datetime(date_joined or utils.get_datetime_now())
+
+    user = User()
+    user.set_password(SEED_PASSWORD)
+    password = user.password
+
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
+        (qn(User._meta.db_table),
+         ', '.join(qn(c) for c in ('username', 'first_name', 'last_name', 'email',
+                                   'password', 'is_staff', 'is_active', 'is_superuser',
+                                   'last_login', 'date_joined')),
+         ', '.join(['%s'] * 10))
+
+    for start in range(offset, offset + count, batch_size):
+        rows = []
+        for number in range(start, min(start + batch_size, offset + count)):
+            if number < 16 ** 5 and date_joined is None:
+                username = '%05x' % number
+            else:
+                username = 'seed%d' % number
+            rows.append((username, '', '', '%s@example.com' % username, password,
+                         False, active, False, now, joined))
+        cursor.executemany(sql, rows)
+
+    _insert_select(LutefiskSignup,
+                   {'email_lower': 'LOWER(%s)' % qn('email'),
+                    'username_lower': 'LOWER(%s)' % qn('username')},
+                   last_id)
+    _insert_select(utils.get_profile_model(), {}, last_id)
+    transaction.commit_unless_managed()
+
+    return User.objects.count()
+
+
+def measure(func, repeat=1):
+    """
+    Calls ``func`` ``repeat`` times.
+
+    :return: Dictionary with the ``seconds``, ``queries``, ``writes``,
+    ``write_bytes`` and ``hashes`` per call.
+
+    """
+    with QueryCounter() as counter:
+        started = time.time()
+        for i in range(repeat):
+            func()
+        seconds = time.time() - started
+    return {'seconds': seconds / repeat,
+            'queries': float(counter.count) / repeat,
+            'writes': float(counter.writes) / repeat,
+            'write_bytes': float(counter.write_bytes) / repeat,
+            'hashes': float(counter.hashes) / repeat}
+
+
+def measure_each(funcs):
+    """
+    Calls every function in ``funcs`` once.
+
+    :return: Dictionary with the mean, minimum and maximum ``seconds`` and
+    the mean ``queries``, ``writes``, ``write_bytes`` and ``hashes`` per
+    call.
+
+    """
+    timings, queries, writes, write_bytes, hashes = [], 0, 0, 0, 0
+    for func in funcs:
+        with QueryCounter() as counter:
+            started = time.time()
+            func()
+            timings.append(time.time() - started)
+        queries += counter.count
+        writes += counter.writes
+        write_bytes += counter.write_bytes
+        hashes += counter.hashes
+    return {'seconds': sum(timings) / len(timings),
+            'min_seconds': min(timings),
+            'max_seconds': max(timings),
+            'queries': float(queries) / len(timings),
+            'writes': float(writes) / len(timings),
+            'write_bytes': float(write_bytes) / len(timings),
+            'hashes': float(hashes) / len(timings)}
+
+
+def _new_users(count, active=False):
+    """ Creates ``count`` users through :func:`create_user`. """
+    allocator = allocators.get_username_allocator()
+    users = []
+    for i in range(count):
+        username = allocator.allocate()
+        users.append(LutefiskSignup.objects.create_user(username,
+                                                        'bench-%s@example.com' % username,
+                                                        SEED_PASSWORD,
+                                                        active=active,
+                                                        send_email=False))
+    return users
+
+
+def _signed_in_client(user):
+    client = Client()
+    client.login(identification=user.username, password=SEED_PASSWORD)
+    return client
+
+
+def benchmark_signup(size, samples):
+    client = Client()
+
+    def signup(number):
+        return lambda: client.post(reverse('lutefisk_signup'),
+                                   {'email': 'bench-signup-%d@example.com' % number,
+                                    'password1': SEED_PASSWORD,
+                                    'password2': SEED_PASSWORD})
+    return measure_each([signup(i) for i in range(samples)])
+
+
+def benchmark_create_user(size, samples):
+    usernames = ['bench-create-%d' % i for i in range(samples)]
+
+    def create_user(username):
+        return lambda: LutefiskSignup.objects.create_user(username,
+                                                          '%s@example.com' % username,
+                                                          SEED_PASSWORD,
+                                                          send_email=False)
+    return measure_each([create_user(username) for username in usernames])
+
+
+def benchmark_signin(size, samples):
+    users = _new_users(samples, active=True)
+
+    def signin(user):
+        return lambda: Client().post(reverse('lutefisk_signin'),
+                                     {'identification': user.email,
+                                      'password': SEED_PASSWORD})
+    return measure_each([signin(user) for user in users])
+
+
+def benchmark_activate(size, samples):
+    users = _new_users(samples)
+    keys = dict(LutefiskSignup.objects.filter(user__in=users)
+                .values_list('user', 'activation_key'))
+
+    def activate(user):
+        return lambda: Client().get(reverse('lutefisk_activate',
+                                            args=[user.username, keys[user.pk]]))
+    return measure_each([activate(user) for user in users])
+
+
+def benchmark_change_email(size, samples):
+    signups = [user.lutefisk_signup for user in _new_users(samples, active=True)]
+
+    def change_email(signup):
+        return lambda: signup.change_email('bench-new-%s@example.com' % signup.user.username)
+    return measure_each([change_email(signup) for signup in signups])
+
+
+def benchmark_confirm_email(size, samples):
+    users = _new_users(samples, active=True)
+    for user in users:
+        user.lutefisk_signup.change_email('bench-new-%s@example.com' % user.username)
+    keys = dict(LutefiskSignup.objects.filter(user__in=users)
+                .values_list('user', 'email_confirmation_key'))
+
+    def confirm(user):
+        return lambda: LutefiskSignup.objects.confirm_email(user.username, keys[user.pk])
+    return measure_each([confirm(user) for user in users])
+
+
+def benchmark_email_change_confirm(size, samples):
+    users = _new_users(samples, active=True)
+    confirmations = []
+    for user in users:
+        signup = user.lutefisk_signup
+        signup.change_email('bench-new-%s@example.com' % user.username)
+        confirmations.append((_signed_in_client(user), signup.email_confirmation_key))
+
+    def confirm(client, key):
+        return lambda: client.get(reverse('lutefisk_email_change_confirm', args=[key]))
+    return measure_each([confirm(client, key) for client, key in confirmations])
+
+
+def benchmark_visible_profiles(size, samples):
+    profile_model = utils.get_profile_model()
+    middle = User.objects.order_by('pk').values_list('pk', flat=True)[size // 2]
+    after = profile_model.objects.filter(user=middle).values_list('pk', flat=True)[0]
+
+    def page(user):
+        return lambda: profile_model.objects.get_visible_profiles_page(user, after)
+    return measure_each([page(AnonymousUser()) for i in range(samples)])
+
+
+def benchmark_delete_expired_users(size, samples):
+    expired = utils.get_datetime_now() - datetime.timedelta(days=settings.LUTEFISK_ACTIVATION_DAYS + 1)
+    seed_users(samples, active=False, date_joined=expired)
+    return measure(LutefiskSignup.objects.purge_expired_users)
+
+
+def run(sizes, samples=20, flows=FLOWS):
+    """
+    Runs the benchmarks of ``flows`` at every table size in ``sizes``.
+
+    The table is grown with :func:`seed_users` before the flows of each
+    size are measured, and the users the flows create are removed
+    afterwards. Flows with an entry in ``QUERY_BUDGETS`` or
+    ``HASH_BUDGETS`` get their ``budget`` or ``hash_budget`` in the result.
+
+    :return: Dictionary with the results, ready to be serialized as JSON.
+
+    """
+    results = []
+    for size in sorted(sizes):
+        seed_users(size - User.objects.count())
+
+        for flow in flows:
+            result = globals()['benchmark_%s' % flow](size, samples)
+            result.update({'flow': flow,
+                           'users': size,
+                           'samples': samples})
+            if flow in QUERY_BUDGETS:
+                result['budget'] = QUERY_BUDGETS[flow]
+            if flow in HASH_BUDGETS:
+                result['hash_budget'] = HASH_BUDGETS[flow]
+            results.append(result)
+            User.objects.filter(email__startswith='bench-').delete()
+
+    return {'django': django.get_version(),
+            'database': connection.vendor,
+            'date': utils.get_datetime_now().isoformat(),
+            'results': results}
+
+
+def benchmark_username_allocators(sizes, samples=100, paths=None):
+    """
+    Measures the cost of a signup for every username allocator at the
+    given table sizes.
+
+    The random allocator is skipped once its username space is full.
+
+    :return: List of result dictionaries.
+
+    """
+    if paths is None:
+        paths = ('lutefisk.allocators.RandomUsernameAllocator',
+                 'lutefisk.allocators.SequenceUsernameAllocator')
+
+    results = []
+    for size in sorted(sizes):
+        seed_users(size - User.objects.count())
+
+        for path in paths:
+            if path.endswith('.RandomUsernameAllocator') and size + samples >= 16 ** 5:
+                continue
+
+            allocator = allocators.load_username_allocator(path)
+
+            def signup():
+                username = allocator.allocate()
+                LutefiskSignup.objects.create_user(username,
+                                                   'bench-%s@example.com' % username,
+                                                   'password',
+                                                   send_email=False)
+
+            allocation = measure(allocator.allocate, samples)
+            result = measure(signup, samples)
+            result.update({'allocator': path,
+                           'users': size,
+                           'allocation_queries': allocation['queries'],
+                           'allocation_seconds': allocation['seconds']})
+            results.append(result)
+            User.objects.filter(email__startswith='bench-').delete()
+    return results
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_connection
+from django.utils.hashcompat import md5_constructor
+
+from lutefisk import signals
+from lutefisk.utils import get_datetime_now, normalize_identification
+
+logger = logging.getLogger('lutefisk.bloom')
+
+
+class BloomFilter(object):
+    """
+    Set membership filter without false negatives.
+
+    :meth:`__contains__` returns ``False`` only for values that were never
+    added, and ``True`` for added values and, with a probability of about
+    ``error_rate``, for values that weren't.
+
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(int(round(self.size * math.log(2) / capacity)), 1)
+        self.capacity = capacity
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def get_positions(self, value):
+        digest = md5_constructor(value.encode('utf-8')).hexdigest()
+        first, second = int(digest[:16], 16), int(digest[16:], 16)
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.get_positions(value):
+            self.bits[position // 8] |= 1 << (position % 8)
+        self.count += 1
+
+    def __contains__(self, value):
+        for position in self.get_positions(value):
+            if not self.bits[position // 8] & (1 << (position % 8)):
+                return False
+        return True
+
+
+class EmailFilter(object):
+    """
+    Bloom filter of the normalized email addresses of all signups.
+
+    The filter is built on first use. Signups and confirmed email changes
+    in this process are added through the ``signup_complete`` and
+    ``confirmation_complete`` signals. Every
+    ``LUTEFISK_EMAIL_FILTER_REFRESH_SECONDS`` the addresses that were set
+    since the last refresh, in any process, are added by reading the
+    signups by their indexed ``email_changed`` column. The filter is
+    rebuilt from scratch every ``LUTEFISK_EMAIL_FILTER_REBUILD_SECONDS``
+    and when it is over capacity, which also drops the addresses that are
+    no longer used.
+
+    Refreshes and builds run on a background thread, one at a time, so
+    requests never query the signups or wait for the lock while they run.
+    Requests keep using the current filter in the meantime. Until the first
+    build is done every address might be used.
+
+    """
+    def __init__(self):
+        self.filter = None
+        self.refreshed = 0
+        self.rebuilt = 0
+        self.updating = False
+        self.lock = threading.Lock()
+
+    def get_queryset(self):
+        from lutefisk.models import LutefiskSignup
+        return LutefiskSignup.objects.exclude(email_lower__isnull=True) \
+            .values_list('email_lower', flat=True)
+
+    def rebuild(self):
+        """ Builds a new filter from all signups and replaces the old one. """
+        started = time.time()
+        count = self.get_queryset().count()
+        bloom = BloomFilter(int(count * 2) + 1000, settings.LUTEFISK_EMAIL_FILTER_ERROR_RATE)
+        for email in self.get_queryset().iterator():
+            bloom.add(email)
+
+        self.lock.acquire()
+        try:
+            self.filter = bloom
+            # Addresses set during the build are added by the next refresh.
+            self.refreshed = self.rebuilt = started
+        finally:
+            self.lock.release()
+
+    def update(self, rebuild):
+        try:
+            if rebuild:
+                self.rebuild()
+            else:
+                self.refresh()
+        except Exception:
+            logger.exception('Updating the email filter failed.')
+        finally:
+            self.updating = False
+            close_connection()
+
+    def start_update(self, rebuild):
+        """
+        Starts :meth:`rebuild` or :meth:`refresh` on a background thread,
+        unless an update is running already. Called with the lock held.
+
+        """
+        if self.updating:
+            return
+        self.updating = True
+        thread = threading.Thread(target=self.update, args=(rebuild,),
+                                  name='lutefisk-email-filter')
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self):
+        """
+        Adds the addresses set since the last refresh.
+
+        The refreshes overlap by ``LUTEFISK_EMAIL_FILTER_REFRESH_SECONDS``
+        to cover transactions that committed late and clock differences
+        between hosts.
+
+        """
+        started = time.time()
+        since = get_datetime_now() - datetime.timedelta(seconds=started - self.refreshed +
+                                                        settings.LUTEFISK_EMAIL_FILTER_REFRESH_SECONDS)
+        changed = list(self.get_queryset().filter(email_changed__gte=since))
+        self.lock.acquire()
+        try:
+            for email in changed:
+                self.filter.add(email)
+            self.refreshed = started
+        finally:
+            self.lock.release()
+
+    def check(self):
+        now = time.time()
+        if self.filter is None or self.filter.count > self.filter.capacity or \
+                now - self.rebuilt > settings.LUTEFISK_EMAIL_FILTER_REBUILD_SECONDS:
+            self.start_update(True)
+        elif now - self.refreshed > settings.LUTEFISK_EMAIL_FILTER_REFRESH_SECONDS:
+            self.start_update(False)
+
+    def add(self, email):
+        """ Adds an email address to the filter once it is built. """
+        email = normalize_identification(email)
+        if email and self.filter is not None:
+            self.lock.acquire()
+            try:
+                self.filter.add(email)
+            finally:
+                self.lock.release()
+
+    def might_contain(self, email):
+        """
+        Returns ``False`` if no signup uses ``email``, and ``True`` if one
+        might.
+
+        """
+        self.lock.acquire()
+        try:
+            self.check()
+            if self.filter is None:
+                return True
+            return normalize_identification(email) in self.filter
+        finally:
+            self.lock.release()
+
+email_filter = EmailFilter()
+
+
+def add_signup_email(sender, user, **kwargs):
+    email_filter.add(user.email)
+
+signals.signup_complete.connect(add_signup_email, dispatch_uid='lutefisk.bloom.add_signup_email')
+signals.confirmation_complete.connect(add_signup_email, dispatch_uid='lutefisk.bloom.add_confirmed_email')
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
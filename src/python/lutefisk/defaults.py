@@ -10,13 +10,64 @@ LUTEFISK_ACTIVATION_DAYS = 7
 LUTEFISK_ACTIVATION_NOTIFY = True
 LUTEFISK_ACTIVATION_NOTIFY_DAYS = 5
 LUTEFISK_ACTIVATED = 'ALREADY_ACTIVATED'
+LUTEFISK_EMAIL_CONFIRMATION_DAYS = 7
+LUTEFISK_SIGNED_TOKENS = False
 LUTEFISK_REMEMBER_ME_DAYS = (_('a month'), 30)
 LUTEFISK_FORBIDDEN_USERNAMES = ('signup', 'signin', 'signout')
 LUTEFISK_USE_HTTPS = True
 LUTEFISK_DEFAULT_PRIVACY = 'registered'
 LUTEFISK_USE_MESSAGES = False
 LUTEFISK_LANGUAGE_FIELD = 'language'
+LUTEFISK_LANGUAGE_CACHE_TIMEOUT = 60 * 60 * 24
+LUTEFISK_USER_CACHE = False
+LUTEFISK_USER_CACHE_TIMEOUT = 60 * 15
+LUTEFISK_PROFILE_PAGE_SIZE = 20
+LUTEFISK_PROFILE_COUNT_CACHE_TIMEOUT = 60 * 5
+LUTEFISK_LAST_ACTIVE_INTERVAL = 60 * 5
+LUTEFISK_LAST_ACTIVE_FLUSH_SECONDS = 60
+LUTEFISK_LAST_ACTIVE_BATCH_SIZE = 500
+LUTEFISK_TEMPLATE_CACHE = True
 LUTEFISK_WITHOUT_USERNAMES = True
+LUTEFISK_EMAIL_OUTBOX = False
+LUTEFISK_EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+LUTEFISK_EMAIL_OUTBOX_RETRY_SECONDS = 60
+LUTEFISK_EMAIL_OUTBOX_LEASE_SECONDS = 300
+LUTEFISK_USERNAME_ALLOCATOR = 'lutefisk.allocators.SequenceUsernameAllocator'
+LUTEFISK_USERNAME_PREFIX = 'u'
+LUTEFISK_USERNAME_BLOCK_SIZE = 100
+LUTEFISK_THROTTLE = False
+LUTEFISK_THROTTLE_STORE = 'cache'
+LUTEFISK_THROTTLE_IP_META = 'REMOTE_ADDR'
+LUTEFISK_THROTTLE_RATES = {'signin_ip': '30/300',
+                           'signin_identification': '10/300',
+                           'signup_ip': '10/3600',
+                           'signup_identification': '3/3600',
+                           'password_reset_ip': '10/3600',
+                           'password_reset_identification': '3/3600',
+                           'email_available_ip': '120/60'}
+LUTEFISK_EMAIL_FILTER = False
+LUTEFISK_EMAIL_FILTER_ERROR_RATE = 0.01
+LUTEFISK_EMAIL_FILTER_REFRESH_SECONDS = 60
+LUTEFISK_EMAIL_FILTER_REBUILD_SECONDS = 60 * 60 * 6
+LUTEFISK_SIGNAL_DISPATCH = 'sync'
+LUTEFISK_SIGNAL_THREADS = 2
+LUTEFISK_SIGNAL_QUEUE_SIZE = 1000
+LUTEFISK_SIGNAL_QUEUE_TIMEOUT = 0.1
+LUTEFISK_SIGNAL_MAX_ATTEMPTS = 5
+LUTEFISK_SIGNAL_RETRY_SECONDS = 60
+LUTEFISK_SIGNAL_LEASE_SECONDS = 300
+LUTEFISK_READ_REPLICAS = ()
+LUTEFISK_REPLICA_STICKY_SECONDS = 10
+LUTEFISK_FRAGMENT_CACHE = False
+LUTEFISK_FRAGMENT_CACHE_TIMEOUT = 60 * 60
+LUTEFISK_FRAGMENT_GRACE_SECONDS = 60
+LUTEFISK_FRAGMENT_LOCK_SECONDS = 10
+LUTEFISK_FRAGMENT_LOCK_WAIT = 0.5
+LUTEFISK_INSTRUMENTATION = False
+LUTEFISK_INSTRUMENTATION_SINKS = ('lutefisk.instrumentation.LogSink',)
+LUTEFISK_STATSD_HOST = '127.0.0.1'
+LUTEFISK_STATSD_PORT = 8125
+LUTEFISK_STATSD_PREFIX = 'lutefisk'
 
 # Local Variables:
 # indent-tabs-mode: nil
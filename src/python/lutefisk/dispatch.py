@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import Queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_finished, got_request_exception
+from django.db import close_connection, transaction
+from django.db.models import Model, get_model
+from django.utils import simplejson
+
+from lutefisk import signals
+
+DEFERRABLE_SIGNALS = ('signup_complete', 'activation_complete',
+                      'confirmation_complete', 'password_complete')
+
+logger = logging.getLogger('lutefisk.dispatch')
+
+_state = threading.local()
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+class Metrics(object):
+    """
+    Counters of the deferred dispatches in this process.
+
+    ``receivers`` maps a signal name to the number of dispatches and the
+    total and maximum seconds its receivers took.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {'dispatched': 0, 'failed': 0, 'inline': 0, 'queued': 0}
+        self.receivers = {}
+
+    def incr(self, counter):
+        self.lock.acquire()
+        try:
+            self.counters[counter] += 1
+        finally:
+            self.lock.release()
+
+    def record(self, name, seconds, failed):
+        self.lock.acquire()
+        try:
+            self.counters['dispatched'] += 1
+            if failed:
+                self.counters['failed'] += 1
+            timing = self.receivers.setdefault(name, {'count': 0, 'seconds': 0, 'max_seconds': 0})
+            timing['count'] += 1
+            timing['seconds'] += seconds
+            timing['max_seconds'] = max(timing['max_seconds'], seconds)
+        finally:
+            self.lock.release()
+
+    def as_dict(self):
+        self.lock.acquire()
+        try:
+            data = dict(self.counters)
+            data['receivers'] = dict((name, dict(timing)) for name, timing in self.receivers.items())
+            return data
+        finally:
+            self.lock.release()
+
+metrics = Metrics()
+
+
+def get_signal_name(signal):
+    """ Returns the name of a deferrable lutefisk signal. """
+    for name in DEFERRABLE_SIGNALS:
+        if getattr(signals, name) is signal:
+            return name
+    raise ValueError('%r is not a deferrable lutefisk signal.' % signal)
+
+
+def run(name, kwargs):
+    """
+    Calls the receivers of the signal ``name``.
+
+    Exceptions of receivers are logged instead of raised, so that one
+    failing receiver doesn't stop the others.
+
+    :return: List of the exceptions raised by receivers.
+
+    """
+    started = time.time()
+    responses = getattr(signals, name).send_robust(sender=None, **kwargs)
+    errors = [response for receiver, response in responses if isinstance(response, Exception)]
+    metrics.record(name, time.time() - started, bool(errors))
+    for error in errors:
+        logger.error('Receiver of %s failed: %r', name, error)
+    return errors
+
+
+def serialize(kwargs):
+    """
+    Returns the arguments of a signal as JSON. Model instances are stored
+    by their primary key.
+
+    """
+    data = {}
+    for key, value in kwargs.items():
+        if isinstance(value, Model):
+            value = {'__model__': '%s.%s' % (value._meta.app_label, value._meta.object_name),
+                     'pk': value.pk}
+        data[key] = value
+    return simplejson.dumps(data)
+
+
+def deserialize(payload):
+    """
+    Returns the arguments stored by :func:`serialize`.
+
+    :raises DoesNotExist: When a model instance was deleted in the meantime.
+
+    """
+    kwargs = {}
+    for key, value in simplejson.loads(payload).items():
+        if isinstance(value, dict) and '__model__' in value:
+            model = get_model(*value['__model__'].split('.'))
+            value = model._default_manager.get(pk=value['pk'])
+        kwargs[str(key)] = value
+    return kwargs
+
+
+class ThreadDispatcher(object):
+    """
+    Runs receivers on a pool of ``LUTEFISK_SIGNAL_THREADS`` threads.
+
+    The queue holds at most ``LUTEFISK_SIGNAL_QUEUE_SIZE`` dispatches. When
+    it stays full for ``LUTEFISK_SIGNAL_QUEUE_TIMEOUT`` seconds the
+    receivers run in the sending thread instead, which slows down the
+    producers until the pool catches up.
+
+    """
+    def __init__(self):
+        self.queue = Queue.Queue(settings.LUTEFISK_SIGNAL_QUEUE_SIZE)
+        self.threads = []
+        for i in range(settings.LUTEFISK_SIGNAL_THREADS):
+            thread = threading.Thread(target=self.work, name='lutefisk-dispatch-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, name, kwargs):
+        try:
+            self.queue.put((name, kwargs), timeout=settings.LUTEFISK_SIGNAL_QUEUE_TIMEOUT)
+        except Queue.Full:
+            metrics.incr('inline')
+            run(name, kwargs)
+        else:
+            metrics.incr('queued')
+
+    def work(self):
+        while True:
+            name, kwargs = self.queue.get()
+            try:
+                run(name, kwargs)
+            except Exception:
+                logger.exception('Dispatch of %s failed.', name)
+            finally:
+                close_connection()
+                self.queue.task_done()
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+
+def get_dispatcher():
+    """ Returns the :class:`ThreadDispatcher`, starting it on first use. """
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher_lock.acquire()
+        try:
+            if _dispatcher is None:
+                _dispatcher = ThreadDispatcher()
+        finally:
+            _dispatcher_lock.release()
+    return _dispatcher
+
+
+def send(signal, **kwargs):
+    """
+    Sends one of the ``DEFERRABLE_SIGNALS`` with ``sender=None`` in the
+    mode selected by ``LUTEFISK_SIGNAL_DISPATCH``:
+
+    ``sync``
+        The receivers run right away, like ``signal.send``.
+
+    ``thread``
+        The receivers run on the :class:`ThreadDispatcher`. Inside a
+        managed transaction the dispatch waits until the request has
+        finished, so receivers see the committed data. It is dropped when
+        the request fails.
+
+    ``queue``
+        The signal is stored as a :class:`LutefiskEvent` and dispatched by
+        the ``dispatch_signals`` command. The event is written in the
+        current transaction, but lutefisk sends its signals after the
+        change that caused them was committed, so a crash in between
+        loses the signal.
+
+    """
+    mode = settings.LUTEFISK_SIGNAL_DISPATCH
+    if mode == 'sync':
+        return signal.send(sender=None, **kwargs)
+
+    name = get_signal_name(signal)
+    if mode == 'thread':
+        if transaction.is_managed():
+            pending = getattr(_state, 'pending', None)
+            if pending is None:
+                pending = _state.pending = []
+            pending.append((name, kwargs))
+        else:
+            get_dispatcher().put(name, kwargs)
+    elif mode == 'queue':
+        from lutefisk.models import LutefiskEvent
+        LutefiskEvent.objects.enqueue(name, serialize(kwargs))
+        metrics.incr('queued')
+    else:
+        raise ImproperlyConfigured('LUTEFISK_SIGNAL_DISPATCH must be sync, thread or queue.')
+    return []
+
+
+def flush(**kwargs):
+    """ Hands the dispatches deferred by this thread to the pool. """
+    pending = getattr(_state, 'pending', None)
+    _state.pending = None
+    if pending:
+        dispatcher = get_dispatcher()
+        for name, signal_kwargs in pending:
+            dispatcher.put(name, signal_kwargs)
+
+
+def discard(**kwargs):
+    """ Drops the dispatches deferred by this thread. """
+    _state.pending = None
+
+
+def get_metrics():
+    """
+    Returns the dispatch counters, the receiver durations and the number
+    of dispatches waiting in the queue of the current mode.
+
+    """
+    data = metrics.as_dict()
+    data['mode'] = settings.LUTEFISK_SIGNAL_DISPATCH
+    if data['mode'] == 'thread':
+        data['queue_depth'] = _dispatcher and _dispatcher.queue_depth() or 0
+    elif data['mode'] == 'queue':
+        from lutefisk.models import LutefiskEvent
+        data['queue_depth'] = LutefiskEvent.objects.queue_depth()
+    else:
+        data['queue_depth'] = 0
+    return data
+
+request_finished.connect(flush, dispatch_uid='lutefisk.dispatch.flush')
+got_request_exception.connect(discard, dispatch_uid='lutefisk.dispatch.discard')
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
@@ -1,16 +1,16 @@
 # -*- coding: utf-8 -*-
 
-import random
-
 from django import forms
 from django.conf import settings
 from django.contrib.auth import authenticate, forms as auth_forms
 from django.contrib.auth.models import User
-from django.utils.hashcompat import sha_constructor
+from django.db import IntegrityError
 from django.utils.translation import ugettext_lazy as _
 
+from lutefisk import routers
+from lutefisk.allocators import get_username_allocator
 from lutefisk.models import LutefiskSignup
-from lutefisk.utils import get_profile_model
+from lutefisk.utils import get_profile_model, normalize_identification
 
 required_attrs = {'class': 'required'}
 
@@ -32,9 +32,17 @@ class SignupForm(forms.Form):
     password2 = forms.CharField(widget=widget, label=_("Repeat password"))
 
     def clean_email(self):
-        """ Validate that the e-mail address is unique. """
+        """
+        Validate that the e-mail address is unique. Every user has a signup
+        with the normalized address, so the indexed ``email_lower`` column
+        covers all users.
+
+        """
         cleaned_email = self.cleaned_data['email']
-        if User.objects.filter(email__iexact=cleaned_email):
+        email_lower = normalize_identification(cleaned_email)
+        with routers.replica():
+            taken = LutefiskSignup.objects.filter(email_lower=email_lower).exists()
+        if taken:
             raise forms.ValidationError(_(u'This email address is already in use by someone else.'))
         return cleaned_email
 
@@ -51,21 +59,32 @@ class SignupForm(forms.Form):
         return self.cleaned_data
 
     def save(self):
-        """ Creates a new user and account. Returns the newly created user. """
-        while True:
-            username = sha_constructor(str(random.random())).hexdigest()[:5]
-            try:
-                User.objects.get(username__iexact=username)
-            except User.DoesNotExist: break
+        """
+        Creates a new user and account. Returns the newly created user.
+
+        When a concurrent signup took the email address after it was
+        validated, no user is created, an error is added to the ``email``
+        field and ``None`` is returned.
+
+        """
+        username = get_username_allocator().allocate()
 
         cleaned_email = self.cleaned_data['email']
         password = self.cleaned_data['password1']
 
-        new_user = LutefiskSignup.objects.create_user(username,
-                                                      cleaned_email,
-                                                      password,
-                                                      not settings.LUTEFISK_ACTIVATION_REQUIRED,
-                                                      settings.LUTEFISK_ACTIVATION_REQUIRED)
+        try:
+            new_user = LutefiskSignup.objects.create_user(username,
+                                                          cleaned_email,
+                                                          password,
+                                                          not settings.LUTEFISK_ACTIVATION_REQUIRED,
+                                                          settings.LUTEFISK_ACTIVATION_REQUIRED)
+        except IntegrityError:
+            email_lower = normalize_identification(cleaned_email)
+            if not LutefiskSignup.objects.filter(email_lower=email_lower).exists():
+                raise
+            self._errors['email'] = self.error_class([_(u'This email address is already in use by someone else.')])
+            del self.cleaned_data['email']
+            return None
         return new_user
 
 class SignupFormTos(SignupForm):
@@ -91,6 +110,7 @@ class AuthenticationForm(forms.Form):
     remember_me = forms.BooleanField(widget=forms.CheckboxInput(), required=False)
 
     def __init__(self, *args, **kwargs):
+        self.user_cache = None
         super(AuthenticationForm, self).__init__(*args, **kwargs)
         self.fields['remember_me'].label = _(u'Remember me for %(days)s') % \
             {'days': _(settings.LUTEFISK_REMEMBER_ME_DAYS[0])}
@@ -100,17 +120,23 @@ class AuthenticationForm(forms.Form):
         Checks for the identification and password.
 
         If the combination can't be found will raise an invalid sign in error.
+        The authenticated user is kept so that it can be retrieved with
+        :func:`get_user` without checking the password again.
 
         """
         identification = self.cleaned_data.get('identification')
         password = self.cleaned_data.get('password')
 
         if identification and password:
-            user = authenticate(identification=identification, password=password)
-            if user is None:
+            self.user_cache = authenticate(identification=identification, password=password)
+            if self.user_cache is None:
                 raise forms.ValidationError(_(u"The password associated with this email address is incorrect."))
         return self.cleaned_data
 
+    def get_user(self):
+        """ Returns the :class:`User` that was authenticated by :func:`clean`. """
+        return self.user_cache
+
 class ChangeEmailForm(forms.Form):
 
     legend = _('Change Email')
@@ -133,11 +159,19 @@ class ChangeEmailForm(forms.Form):
             self.user = user
 
     def clean_email(self):
-        """ Validate that the email is not already registered with another user """
+        """
+        Validate that the email is not already registered with another user.
+        Like :meth:`SignupForm.clean_email` this checks the indexed
+        ``email_lower`` column of the signups.
+
+        """
         cleaned_email = self.cleaned_data['email']
         if cleaned_email.lower() == self.user.email:
             raise forms.ValidationError(_(u'This is your current email address.'))
-        if User.objects.filter(email__iexact=cleaned_email).exclude(email__iexact=self.user.email):
+        email_lower = normalize_identification(cleaned_email)
+        with routers.replica():
+            taken = LutefiskSignup.objects.filter(email_lower=email_lower).exclude(user=self.user).exists()
+        if taken:
             raise forms.ValidationError(_(u'This email address is already in use by someone else.'))
         return cleaned_email
 
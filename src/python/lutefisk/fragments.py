@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils import translation
+
+from lutefisk import routers
+from lutefisk import utils
+
+
+def get_profile_version_key(user_id):
+    return 'lutefisk:profile-version:%s' % user_id
+
+
+def get_profile_version(user_id):
+    """
+    Returns the current version of the profile of a user.
+
+    A missing version starts at the current time in microseconds, so that
+    it is higher than any version that expired or was evicted before.
+
+    :param user_id:
+    The primary key of the :class:`User`.
+
+    """
+    key = get_profile_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000000),
+                  settings.LUTEFISK_FRAGMENT_CACHE_TIMEOUT + settings.LUTEFISK_FRAGMENT_GRACE_SECONDS)
+        version = cache.get(key)
+    return version
+
+
+def bump_profile_version(user_id):
+    """
+    Invalidates everything cached for the profile of a user.
+
+    Called whenever the profile, the :class:`User` or the
+    :class:`LutefiskSignup` is saved or deleted. Call it after changing
+    them with ``QuerySet.update`` as well.
+
+    """
+    try:
+        cache.incr(get_profile_version_key(user_id))
+    except ValueError:
+        # No version yet, so nothing was cached.
+        pass
+
+
+def cached(key, render, timeout=None):
+    """
+    Returns the value cached under ``key``, calling ``render`` to create
+    it when needed.
+
+    Only one process renders a value at a time. When a value is older than
+    ``timeout`` one process refreshes it while the others keep serving the
+    old value for up to ``LUTEFISK_FRAGMENT_GRACE_SECONDS``. When there is
+    no value at all the others wait up to ``LUTEFISK_FRAGMENT_LOCK_WAIT``
+    seconds for it before they render it themselves.
+
+    :param key:
+    String containing the cache key.
+
+    :param render:
+    Callable without arguments that returns the value.
+
+    :param timeout:
+    Optional seconds after which the value is refreshed. Defaults to
+    ``LUTEFISK_FRAGMENT_CACHE_TIMEOUT``.
+
+    """
+    if timeout is None:
+        timeout = settings.LUTEFISK_FRAGMENT_CACHE_TIMEOUT
+    lock_key = '%s:lock' % key
+
+    entry = cache.get(key)
+    if entry is not None:
+        value, refresh_at = entry
+        if refresh_at > time.time():
+            return value
+        locked = cache.add(lock_key, 1, settings.LUTEFISK_FRAGMENT_LOCK_SECONDS)
+        if not locked:
+            return value
+    else:
+        locked = cache.add(lock_key, 1, settings.LUTEFISK_FRAGMENT_LOCK_SECONDS)
+        if not locked:
+            deadline = time.time() + settings.LUTEFISK_FRAGMENT_LOCK_WAIT
+            while time.time() < deadline:
+                time.sleep(0.05)
+                entry = cache.get(key)
+                if entry is not None:
+                    return entry[0]
+
+    try:
+        value = render()
+        cache.set(key, (value, time.time() + timeout),
+                  timeout + settings.LUTEFISK_FRAGMENT_GRACE_SECONDS)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+    return value
+
+
+def get_profile_fragment(name, user_id, render, timeout=None):
+    """
+    Returns a fragment of a profile page from the cache.
+
+    The key contains the profile version and the active language, so a
+    fragment is never served after the profile changed.
+
+    :param name:
+    String that names the fragment, like ``detail``.
+
+    :param user_id:
+    The primary key of the :class:`User` whose profile is shown.
+
+    :param render:
+    Callable without arguments that renders the fragment.
+
+    """
+    if not settings.LUTEFISK_FRAGMENT_CACHE:
+        return render()
+    key = 'lutefisk:profile-fragment:%s:%s:%s:%s' % (name, user_id,
+                                                     get_profile_version(user_id),
+                                                     translation.get_language())
+    return cached(key, render, timeout)
+
+
+def get_cached_profile(request):
+    """
+    Returns the profile of the signed in user like
+    :func:`get_request_profile`, but from the cache.
+
+    The profile is cached together with its user and
+    :class:`LutefiskSignup` under the profile version. It is always read
+    from the primary, because a lagging replica could fill the new version
+    with the data that was just invalidated.
+
+    """
+    if not settings.LUTEFISK_FRAGMENT_CACHE:
+        return utils.get_request_profile(request)
+
+    profile = getattr(request, '_lutefisk_profile', None)
+    if profile is None:
+        user = request.user
+
+        def load():
+            with routers.primary():
+                return utils.get_profile_model().objects \
+                    .select_related('user__lutefisk_signup').get(user=user.pk)
+
+        key = 'lutefisk:profile:%s:%s' % (user.pk, get_profile_version(user.pk))
+        profile = cached(key, load)
+        # The signup may be missing, see utils.get_request_profile.
+        try:
+            signup = profile.user.lutefisk_signup
+        except ObjectDoesNotExist:
+            signup = None
+        if signup is not None:
+            user._lutefisk_signup_cache = signup
+        user._profile_cache = profile
+        profile._user_cache = user
+        request._lutefisk_profile = profile
+    return profile
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
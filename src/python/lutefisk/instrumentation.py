@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils.functional import wraps
+from django.utils.importlib import import_module
+
+from lutefisk import signals
+
+_state = threading.local()
+_sinks = None
+
+logger = logging.getLogger('lutefisk.instrumentation')
+
+
+class Report(object):
+    """
+    Timings and query counts collected during one request.
+
+    ``timings`` maps a category like ``hash``, ``template``, ``smtp`` or
+    ``manager.activate_user`` to the seconds spent in it, ``calls`` to the
+    number of times it was entered and ``queries`` to the number of
+    queries it ran.
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self.timings = {}
+        self.calls = {}
+        self.queries = {}
+        self.started = time.time()
+        self.query_start = len(connection.queries)
+        self.seconds = None
+        self.db_queries = None
+        self.db_seconds = None
+
+    def add(self, category, seconds, queries=0):
+        self.timings[category] = self.timings.get(category, 0) + seconds
+        self.calls[category] = self.calls.get(category, 0) + 1
+        self.queries[category] = self.queries.get(category, 0) + queries
+
+    def finish(self):
+        self.seconds = time.time() - self.started
+        queries = connection.queries[self.query_start:]
+        self.db_queries = len(queries)
+        self.db_seconds = sum(float(query['time']) for query in queries)
+
+    def as_dict(self):
+        return {'name': self.name,
+                'seconds': self.seconds,
+                'db_queries': self.db_queries,
+                'db_seconds': self.db_seconds,
+                'timings': self.timings,
+                'calls': self.calls,
+                'queries': self.queries}
+
+
+class Timer(object):
+    """ Context manager that adds its duration to the current report. """
+
+    def __init__(self, report, category):
+        self.report = report
+        self.category = category
+
+    def __enter__(self):
+        self.query_start = len(connection.queries)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.report.add(self.category, time.time() - self.started,
+                        len(connection.queries) - self.query_start)
+
+
+class NoopTimer(object):
+    """ Context manager used when nothing is being instrumented. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_noop_timer = NoopTimer()
+
+
+def get_report():
+    """ Returns the :class:`Report` of the current thread or ``None``. """
+    return getattr(_state, 'report', None)
+
+
+def timer(category):
+    """
+    Returns a context manager that times ``category`` in the current
+    report. Costs one attribute lookup when nothing is instrumented.
+
+    """
+    report = getattr(_state, 'report', None)
+    if report is None:
+        return _noop_timer
+    return Timer(report, category)
+
+
+def instrumented(category):
+    """
+    Decorator that times every call of the decorated function as
+    ``category``.
+
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            report = getattr(_state, 'report', None)
+            if report is None:
+                return func(*args, **kwargs)
+            with Timer(report, category):
+                return func(*args, **kwargs)
+        return wraps(func)(wrapper)
+    return decorator
+
+
+def start(name):
+    """
+    Starts collecting a report named ``name`` for the current thread.
+
+    Queries are only recorded by Django's debug cursor, so it is turned
+    on until :func:`finish` is called.
+
+    """
+    if getattr(_state, 'report', None) is None:
+        _state.use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    _state.report = Report(name)
+    return _state.report
+
+
+def finish():
+    """
+    Finishes the report of the current thread and publishes it.
+
+    :return: The finished :class:`Report` or ``None``.
+
+    """
+    report = getattr(_state, 'report', None)
+    if report is None:
+        return None
+
+    _state.report = None
+    report.finish()
+    connection.use_debug_cursor = _state.use_debug_cursor
+
+    signals.instrumentation_report.send(sender=None, report=report)
+    for sink in get_sinks():
+        try:
+            sink(report)
+        except Exception:
+            logger.exception('Instrumentation sink %r failed.', sink)
+    return report
+
+
+def get_sinks():
+    """
+    Returns the sinks defined by ``LUTEFISK_INSTRUMENTATION_SINKS``.
+
+    A sink is a callable that receives every finished :class:`Report`.
+
+    """
+    global _sinks
+    if _sinks is None:
+        sinks = []
+        for path in settings.LUTEFISK_INSTRUMENTATION_SINKS:
+            module_name, attr = path.rsplit('.', 1)
+            try:
+                sink = getattr(import_module(module_name), attr)
+            except (ImportError, AttributeError), e:
+                raise ImproperlyConfigured('Error loading instrumentation sink %s: "%s"' % (path, e))
+            if isinstance(sink, type):
+                sink = sink()
+            sinks.append(sink)
+        _sinks = sinks
+    return _sinks
+
+
+class LogSink(object):
+    """ Writes every report to the ``lutefisk.instrumentation`` logger. """
+
+    def __call__(self, report):
+        logger.info('%s %.1fms db=%d/%.1fms %s', report.name,
+                    report.seconds * 1000, report.db_queries,
+                    report.db_seconds * 1000,
+                    ' '.join('%s=%.1fms' % (category, seconds * 1000)
+                             for category, seconds in sorted(report.timings.items())))
+
+
+class CounterSink(object):
+    """
+    Aggregates the reports in the in-process ``counters`` registry.
+
+    ``counters`` maps a report name to a dictionary with the number of
+    ``requests`` and the summed ``seconds``, ``db_queries``, ``db_seconds``
+    and category timings.
+
+    """
+    counters = {}
+    lock = threading.Lock()
+
+    def __call__(self, report):
+        self.lock.acquire()
+        try:
+            counter = self.counters.setdefault(report.name, {})
+            values = [('requests', 1),
+                      ('seconds', report.seconds),
+                      ('db_queries', report.db_queries),
+                      ('db_seconds', report.db_seconds)]
+            values.extend(report.timings.items())
+            for key, value in values:
+                counter[key] = counter.get(key, 0) + value
+        finally:
+            self.lock.release()
+
+
+class StatsdSink(object):
+    """
+    Sends every report as statsd timers and counters over UDP to
+    ``LUTEFISK_STATSD_HOST`` and ``LUTEFISK_STATSD_PORT``.
+
+    """
+    def __init__(self):
+        self.address = (settings.LUTEFISK_STATSD_HOST, settings.LUTEFISK_STATSD_PORT)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, report):
+        prefix = '%s.%s' % (settings.LUTEFISK_STATSD_PREFIX, report.name)
+        lines = ['%s.time:%d|ms' % (prefix, report.seconds * 1000),
+                 '%s.db_queries:%d|c' % (prefix, report.db_queries),
+                 '%s.db_time:%d|ms' % (prefix, report.db_seconds * 1000)]
+        for category, seconds in report.timings.items():
+            lines.append('%s.%s:%d|ms' % (prefix, category, seconds * 1000))
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
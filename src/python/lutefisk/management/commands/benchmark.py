@@ -0,0 +1,64 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.utils import simplejson
+
+from lutefisk import benchmarks
+
+class Command(NoArgsCommand):
+    """
+    Time lutefisk's hot paths and count their queries at several user
+    table sizes, on a throw-away test database, and write the results as
+    JSON.
+
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes', action='store', type='string',
+                    dest='sizes', default='10000,100000,1000000',
+                    help='Comma separated user table sizes.'),
+        make_option('--samples', action='store', type='int',
+                    dest='samples', default=20,
+                    help='Number of calls measured per flow and size.'),
+        make_option('--flows', action='store', type='string',
+                    dest='flows', default=','.join(benchmarks.FLOWS),
+                    help='Comma separated flows to measure.'),
+        make_option('--output', action='store', type='string',
+                    dest='output', default='benchmark.json',
+                    help='File the JSON results are written to.'),
+        )
+
+    help = 'Benchmarks lutefisk at realistic table sizes.'
+    def handle_noargs(self, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        flows = options['flows'].split(',')
+        for flow in flows:
+            if flow not in benchmarks.FLOWS:
+                raise CommandError('Unknown flow: %s' % flow)
+
+        old_name = benchmarks.setup_database()
+        try:
+            results = benchmarks.run(sizes, options['samples'], flows)
+        finally:
+            benchmarks.teardown_database(old_name)
+
+        output = open(options['output'], 'w')
+        try:
+            simplejson.dump(results, output, indent=2)
+        finally:
+            output.close()
+
+        if int(options.get('verbosity', 1)) > 0:
+            for result in results['results']:
+                self.stdout.write('%(flow)s users=%(users)d queries=%(queries).2f '
+                                  'writes=%(writes).2f write_bytes=%(write_bytes).0f '
+                                  'hashes=%(hashes).2f ms=%(ms).3f\n' %
+                                  dict(result, ms=result['seconds'] * 1000))
+
+        over_budget = ['%(flow)s users=%(users)d queries=%(queries).2f budget=%(budget)d' % result
+                       for result in results['results']
+                       if 'budget' in result and result['queries'] > result['budget']]
+        over_budget += ['%(flow)s users=%(users)d hashes=%(hashes).2f hash_budget=%(hash_budget)d' % result
+                        for result in results['results']
+                        if 'hash_budget' in result and result['hashes'] > result['hash_budget']]
+        if over_budget:
+            raise CommandError('Budget exceeded: %s' % '; '.join(over_budget))
@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from lutefisk import benchmarks
+
+class Command(NoArgsCommand):
+    """
+    Compare the signup cost of the username allocators at different user
+    table sizes, on a throw-away test database.
+
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes', action='store', type='string',
+                    dest='sizes', default='1000,10000,100000',
+                    help='Comma separated user table sizes.'),
+        make_option('--samples', action='store', type='int',
+                    dest='samples', default=100,
+                    help='Number of signups measured per allocator and size.'),
+        )
+
+    help = 'Benchmarks the username allocators.'
+    def handle_noargs(self, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+
+        old_name = benchmarks.setup_database()
+        try:
+            results = benchmarks.benchmark_username_allocators(sizes, options['samples'])
+        finally:
+            benchmarks.teardown_database(old_name)
+
+        for result in results:
+            self.stdout.write('%(allocator)s users=%(users)d '
+                              'allocation_queries=%(allocation_queries).2f '
+                              'signup_queries=%(queries).2f '
+                              'signup_ms=%(seconds).3f\n' %
+                              dict(result, seconds=result['seconds'] * 1000))
@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from lutefisk.models import LutefiskSignup
+
+class Command(NoArgsCommand):
+    """
+    Search for email changes that still haven't been confirmed after
+    ``LUTEFISK_EMAIL_CONFIRMATION_DAYS`` and clear them.
+
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=1000,
+                    help='Number of email changes cleared per transaction.'),
+        make_option('--max-seconds', action='store', type='float',
+                    dest='max_seconds', default=None,
+                    help='Stop starting new batches after this many seconds.'),
+        make_option('--dry-run', action='store_true',
+                    dest='dry_run', default=False,
+                    help='Only count the expired email changes.'),
+        )
+
+    help = 'Clears expired email change confirmations.'
+    def handle_noargs(self, **options):
+        count = LutefiskSignup.objects.purge_expired_email_confirmations(batch_size=options['batch_size'],
+                                                                         max_seconds=options['max_seconds'],
+                                                                         dry_run=options['dry_run'])
+
+        if int(options.get('verbosity', 1)) > 0:
+            if options['dry_run']:
+                self.stdout.write('%d expired email changes would be cleared.\n' % count)
+            else:
+                self.stdout.write('%d expired email changes cleared.\n' % count)
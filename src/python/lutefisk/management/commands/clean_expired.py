@@ -1,3 +1,5 @@
+from optparse import make_option
+
 from django.core.management.base import NoArgsCommand
 
 from lutefisk.models import LutefiskSignup
@@ -8,6 +10,26 @@ class Command(NoArgsCommand):
     ``LUTEFISK_ACTIVATION_DAYS`` and delete them.
 
     """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=1000,
+                    help='Number of users deleted per transaction.'),
+        make_option('--max-seconds', action='store', type='float',
+                    dest='max_seconds', default=None,
+                    help='Stop starting new batches after this many seconds.'),
+        make_option('--dry-run', action='store_true',
+                    dest='dry_run', default=False,
+                    help='Only count the expired users.'),
+        )
+
     help = 'Deletes expired users.'
     def handle_noargs(self, **options):
-        users = LutefiskSignup.objects.delete_expired_users()
+        count = LutefiskSignup.objects.purge_expired_users(batch_size=options['batch_size'],
+                                                           max_seconds=options['max_seconds'],
+                                                           dry_run=options['dry_run'])
+
+        if int(options.get('verbosity', 1)) > 0:
+            if options['dry_run']:
+                self.stdout.write('%d expired users would be deleted.\n' % count)
+            else:
+                self.stdout.write('%d expired users deleted.\n' % count)
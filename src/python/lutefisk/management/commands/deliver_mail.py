@@ -0,0 +1,42 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from lutefisk.models import LutefiskMail
+
+class Command(NoArgsCommand):
+    """
+    Deliver the emails that are waiting in the lutefisk outbox.
+
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=100,
+                    help='Number of emails claimed and sent per connection.'),
+        make_option('--loop', action='store_true',
+                    dest='loop', default=False,
+                    help='Keep polling the outbox instead of exiting when it is empty.'),
+        make_option('--sleep', action='store', type='float',
+                    dest='sleep', default=5,
+                    help='Seconds to wait between polls with --loop.'),
+        )
+
+    help = 'Delivers queued lutefisk emails.'
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        while True:
+            sent, failed = LutefiskMail.objects.deliver(batch_size=options['batch_size'])
+
+            if verbosity > 0 and (sent or failed):
+                self.stdout.write('%d emails sent, %d failed, %d queued.\n' %
+                                  (sent, failed, LutefiskMail.objects.queue_depth()))
+
+            if not (sent or failed):
+                if not options['loop']:
+                    break
+                time.sleep(options['sleep'])
+
+        if verbosity > 0:
+            self.stdout.write('%d emails queued.\n' % LutefiskMail.objects.queue_depth())
@@ -0,0 +1,48 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from lutefisk import dispatch
+from lutefisk.models import LutefiskEvent
+
+class Command(NoArgsCommand):
+    """
+    Run the receivers of the lutefisk signals that are waiting in the
+    queue.
+
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=100,
+                    help='Number of events claimed per batch.'),
+        make_option('--loop', action='store_true',
+                    dest='loop', default=False,
+                    help='Keep polling the queue instead of exiting when it is empty.'),
+        make_option('--sleep', action='store', type='float',
+                    dest='sleep', default=1,
+                    help='Seconds to wait between polls with --loop.'),
+        )
+
+    help = 'Dispatches queued lutefisk signals.'
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        while True:
+            done, failed = LutefiskEvent.objects.dispatch(batch_size=options['batch_size'])
+
+            if verbosity > 0 and (done or failed):
+                self.stdout.write('%d events dispatched, %d failed, %d queued.\n' %
+                                  (done, failed, LutefiskEvent.objects.queue_depth()))
+
+            if not (done or failed):
+                if not options['loop']:
+                    break
+                time.sleep(options['sleep'])
+
+        if verbosity > 0:
+            self.stdout.write('%d events queued.\n' % LutefiskEvent.objects.queue_depth())
+            for name, timing in sorted(dispatch.get_metrics()['receivers'].items()):
+                self.stdout.write('%s: %d dispatches, %.3fs mean, %.3fs max.\n' %
+                                  (name, timing['count'], timing['seconds'] / timing['count'],
+                                   timing['max_seconds']))
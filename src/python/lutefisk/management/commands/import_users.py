@@ -0,0 +1,104 @@
+import csv
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import LabelCommand, CommandError
+from django.utils import simplejson
+
+from lutefisk.models import LutefiskSignup
+
+class Command(LabelCommand):
+    """
+    Create users from a CSV or JSON lines file.
+
+    Every record needs an ``email`` and a ``password`` or ``password_hash``,
+    a ``username`` is optional. CSV files must have a header row. The file
+    is read as a stream, so memory use doesn't depend on its size. Use
+    ``-`` to read from standard input.
+
+    """
+    option_list = LabelCommand.option_list + (
+        make_option('--format', action='store', type='choice',
+                    choices=('csv', 'jsonl'), dest='format', default=None,
+                    help='Input format, guessed from the file name by default.'),
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=500,
+                    help='Number of users created per transaction.'),
+        make_option('--active', action='store_true',
+                    dest='active', default=False,
+                    help='Create active users that need no activation.'),
+        make_option('--send-email', action='store_true',
+                    dest='send_email', default=False,
+                    help='Queue activation emails in the outbox.'),
+        )
+
+    help = 'Imports users from CSV or JSON lines files.'
+    label = 'file'
+
+    def handle_label(self, path, **options):
+        input_format = options['format']
+        if input_format is None:
+            input_format = path.endswith('.csv') and 'csv' or 'jsonl'
+
+        if path == '-':
+            stream = sys.stdin
+        else:
+            try:
+                stream = open(path, 'rb')
+            except IOError, e:
+                raise CommandError(e)
+
+        if input_format == 'csv':
+            records = self.read_csv(stream)
+        else:
+            records = self.read_jsonl(stream)
+
+        self.verbosity = int(options.get('verbosity', 1))
+        started = time.time()
+        read = created = skipped = 0
+        batch = []
+        for record in records:
+            read += 1
+            batch.append(record)
+            if len(batch) >= options['batch_size']:
+                batch_created, batch_skipped = self.create_batch(batch, options)
+                created += batch_created
+                skipped += batch_skipped
+                batch = []
+                if self.verbosity > 0:
+                    self.report(read, created, skipped, started)
+        if batch:
+            batch_created, batch_skipped = self.create_batch(batch, options)
+            created += batch_created
+            skipped += batch_skipped
+
+        if self.verbosity > 0:
+            self.report(read, created, skipped, started)
+
+    def create_batch(self, batch, options):
+        skipped = []
+        users = LutefiskSignup.objects.bulk_create_users(batch,
+                                                         active=options['active'],
+                                                         send_email=options['send_email'],
+                                                         skipped=skipped)
+        if self.verbosity > 1:
+            for record, reason in skipped:
+                self.stdout.write('Skipped %s: %s.\n' %
+                                  (record.get('email') or record.get('username'), reason))
+        return len(users), len(skipped)
+
+    def report(self, read, created, skipped, started):
+        elapsed = max(time.time() - started, 0.001)
+        self.stdout.write('%d records read, %d users created, %d skipped (%.0f users/s).\n' %
+                          (read, created, skipped, created / elapsed))
+
+    def read_csv(self, stream):
+        for row in csv.DictReader(stream):
+            yield dict((key, value.decode('utf-8')) for key, value in row.items() if value)
+
+    def read_jsonl(self, stream):
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield simplejson.loads(line)
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from lutefisk.models import LutefiskSignup
+
+class Command(NoArgsCommand):
+    """
+    Remind users that haven't activated their account
+    ``LUTEFISK_ACTIVATION_NOTIFY_DAYS`` days before it expires.
+
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=500,
+                    help='Number of reminders claimed and sent per chunk.'),
+        )
+
+    help = 'Sends activation reminders.'
+    def handle_noargs(self, **options):
+        count = LutefiskSignup.objects.send_activation_reminders(batch_size=options['batch_size'])
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('%d activation reminders sent.\n' % count)
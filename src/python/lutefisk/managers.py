@@ -2,15 +2,28 @@
 
 import datetime
 import re
+import time
+import uuid
 
 from django.conf import settings
-from django.contrib.auth.models import User, UserManager, AnonymousUser
-from django.db import models
-from django.db.models import Q
+from django.contrib.auth.models import User, UserManager, AnonymousUser, SiteProfileNotAvailable
+from django.core import mail
+from django.core.cache import cache
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q
 from django.utils.translation import ugettext as _
 
+from lutefisk import dispatch
+from lutefisk import instrumentation
+from lutefisk import rendering
+from lutefisk import routers
 from lutefisk import signals
 from lutefisk import utils
+from lutefisk.allocators import get_username_allocator
+from lutefisk.bloom import email_filter
+from lutefisk.fragments import bump_profile_version
+from lutefisk.instrumentation import instrumented
+from lutefisk.tokens import default_token_generator, get_timestamp
 
 SHA1_RE = re.compile('^[a-f0-9]{40}$')
 
@@ -18,11 +31,24 @@ SHA1_RE = re.compile('^[a-f0-9]{40}$')
 class LutefiskManager(UserManager):
     """ Extra functionality for the Lutefisk model. """
 
+    @instrumented('manager.create_user')
     def create_user(self, username, email, password, active=False,
                     send_email=True):
         """
         A simple wrapper that creates a new :class:`User`.
 
+        The user, its :class:`LutefiskSignup` and its profile are created
+        in a single transaction, so a failure never leaves a half created
+        account behind. The user row is written once with its final
+        ``is_active`` value. With ``LUTEFISK_EMAIL_OUTBOX`` the activation
+        email is stored in the outbox in the same transaction and delivered
+        after the commit by ``deliver_mail``; otherwise it is sent right
+        after the commit.
+
+        Email addresses and usernames are unique regardless of case. When a
+        concurrent signup took the same one the transaction is rolled back
+        and ``IntegrityError`` is raised.
+
         :param username:
         String containing the username of the new user.
 
@@ -45,26 +71,281 @@ class LutefiskManager(UserManager):
 
         """
         now = utils.get_datetime_now()
+        email = utils.normalize_email(email)
 
-        new_user = User.objects.create_user(username, email, password)
-        new_user.is_active = active
-        new_user.save()
+        new_user = User(username=username,
+                        email=email,
+                        is_staff=False,
+                        is_active=active,
+                        is_superuser=False,
+                        last_login=now,
+                        date_joined=now)
+        new_user.set_password(password)
+        # The signup is created here, not by sync_identification.
+        new_user._lutefisk_signup_pending = True
 
-        lutefisk_profile = self.create_lutefisk_profile(new_user)
+        with transaction.commit_on_success(using=self._db):
+            new_user.save(force_insert=True, using=self._db)
 
-        # All users have an empty profile
-        profile_model = utils.get_profile_model()
-        try:
-            new_profile = new_user.get_profile()
-        except profile_model.DoesNotExist:
-            new_profile = profile_model(user=new_user)
-            new_profile.save(using=self._db)
+            lutefisk_profile = self.create_lutefisk_profile(new_user)
+            new_user._lutefisk_signup_pending = False
 
-        if send_email:
+            # All users have an empty profile
+            profile_model = utils.get_profile_model()
+            try:
+                new_profile = new_user.get_profile()
+            except profile_model.DoesNotExist:
+                new_profile = profile_model(user=new_user)
+                new_profile.save(force_insert=True, using=self._db)
+
+            # The outbox is written in the same transaction, so an account
+            # is never committed without its activation email.
+            if send_email and settings.LUTEFISK_EMAIL_OUTBOX:
+                lutefisk_profile.send_activation_email()
+
+        if send_email and not settings.LUTEFISK_EMAIL_OUTBOX:
             lutefisk_profile.send_activation_email()
-            
+
         return new_user
 
+    @instrumented('manager.bulk_create_users')
+    def bulk_create_users(self, users, active=False, send_email=False, skipped=None):
+        """
+        Creates many users, their :class:`LutefiskSignup` and profile at once.
+
+        All rows are inserted in bulk inside a single transaction, so a
+        batch costs a handful of queries instead of several per user.
+        Email addresses are normalized like :func:`create_user` does. Users
+        whose email address or username is already taken, regardless of
+        case and also within ``users``, are skipped.
+
+        :param users:
+        List of dictionaries with an ``email`` and a raw ``password`` or an
+        already hashed ``password_hash``. A ``username`` is optional and is
+        allocated by the username allocator when it's missing.
+
+        :param active:
+        Boolean that defines if the new users are active.
+
+        :param send_email:
+        Boolean that defines if activation emails should be queued in the
+        outbox for the new users.
+
+        :param skipped:
+        Optional list to which a tuple of the dictionary and the reason is
+        appended for every skipped user.
+
+        :return: List of the newly created :class:`User` instances.
+
+        """
+        allocator = get_username_allocator()
+        now = utils.get_datetime_now()
+
+        def skip(data, reason):
+            if skipped is not None:
+                skipped.append((data, reason))
+
+        # Compared like they are stored, after normalize_email.
+        emails = [utils.normalize_identification(utils.normalize_email(u['email']))
+                  if u.get('email') else None for u in users]
+        usernames = [utils.normalize_identification(u.get('username')) for u in users]
+        signups = self.using(self._db)
+        taken_emails = set(utils.values_list_in(signups, 'email_lower',
+                                                [e for e in emails if e],
+                                                ('email_lower',), flat=True))
+        taken_usernames = set(utils.values_list_in(signups, 'username_lower',
+                                                   [u for u in usernames if u],
+                                                   ('username_lower',), flat=True))
+        taken_usernames.update(username.lower() for username in
+                               utils.values_list_in(User.objects.using(self._db), 'username',
+                                                    [u['username'] for u in users if u.get('username')],
+                                                    ('username',), flat=True))
+
+        new_users = []
+        for data, email_lower, username_lower in zip(users, emails, usernames):
+            if not email_lower:
+                skip(data, 'missing email address')
+                continue
+            if email_lower in taken_emails:
+                skip(data, 'email address taken')
+                continue
+            if username_lower in taken_usernames:
+                skip(data, 'username taken')
+                continue
+            taken_emails.add(email_lower)
+            if username_lower:
+                taken_usernames.add(username_lower)
+
+            user = User(username=data.get('username') or allocator.allocate(),
+                        email=utils.normalize_email(data['email']),
+                        is_active=active,
+                        last_login=now,
+                        date_joined=now)
+            if data.get('password_hash'):
+                user.password = data['password_hash']
+            else:
+                user.set_password(data.get('password'))
+            new_users.append(user)
+
+        if not new_users:
+            return []
+
+        with transaction.commit_on_success(using=self._db):
+            utils.bulk_insert(User, new_users, using=self._db)
+
+            pks = dict(utils.values_list_in(User.objects.using(self._db), 'username',
+                                            [u.username for u in new_users],
+                                            ('username', 'pk')))
+            for user in new_users:
+                user.id = pks[user.username]
+
+            signups = [self.model(user=user,
+                                  activation_key=utils.generate_key(),
+                                  email_lower=utils.normalize_identification(user.email),
+                                  username_lower=utils.normalize_identification(user.username))
+                       for user in new_users]
+            utils.bulk_insert(self.model, signups, using=self._db)
+
+            profile_model = utils.get_profile_model()
+            utils.bulk_insert(profile_model,
+                              [profile_model(user=user) for user in new_users],
+                              using=self._db)
+
+        if send_email:
+            for signup in signups:
+                signup.send_activation_email(defer=True)
+
+        return new_users
+
+    def get_activation_reminders(self):
+        """
+        Returns the signups that should get an activation reminder.
+
+        These are inactive users that joined more than
+        ``LUTEFISK_ACTIVATION_DAYS`` minus ``LUTEFISK_ACTIVATION_NOTIFY_DAYS``
+        days ago, whose activation key has not expired yet and who did not
+        get a reminder before. Signups claimed by another worker within the
+        last ``LUTEFISK_EMAIL_OUTBOX_LEASE_SECONDS`` are left out.
+
+        :return: A :class:`LutefiskSignup` queryset.
+
+        """
+        now = utils.get_datetime_now()
+        expiration_days = datetime.timedelta(days=settings.LUTEFISK_ACTIVATION_DAYS)
+        notify_days = datetime.timedelta(days=settings.LUTEFISK_ACTIVATION_NOTIFY_DAYS)
+        lease = datetime.timedelta(seconds=settings.LUTEFISK_EMAIL_OUTBOX_LEASE_SECONDS)
+
+        signups = self.filter(activation_notification_send=False,
+                              user__is_active=False,
+                              user__date_joined__gt=now - expiration_days,
+                              user__date_joined__lte=now - expiration_days + notify_days)
+        signups = signups.exclude(activation_key=settings.LUTEFISK_ACTIVATED)
+        return signups.filter(Q(activation_notification_claimed__isnull=True) |
+                              Q(activation_notification_claimed__lt=now - lease))
+
+    @instrumented('manager.send_activation_reminders')
+    def send_activation_reminders(self, batch_size=500, connection=None):
+        """
+        Sends activation reminders to all eligible users.
+
+        Signups are processed in chunks. Every chunk is claimed with a
+        conditional ``UPDATE``, so workers on several hosts can run at the
+        same time without sending duplicates. The claim repeats the inactive
+        and unexpired conditions, so users who activated after the chunk was
+        selected get no reminder. The chunk's reminders are sent
+        over one connection and marked as sent with a single ``UPDATE``.
+        Every reminder is rendered in the language of the user's profile.
+
+        :param batch_size:
+        Integer with the number of reminders sent per chunk.
+
+        :param connection:
+        Optional email backend connection. Defaults to
+        :func:`get_connection`.
+
+        :return: The number of reminders sent.
+
+        """
+        if not settings.LUTEFISK_ACTIVATION_NOTIFY:
+            return 0
+
+        if connection is None:
+            connection = mail.get_connection()
+
+        lease = datetime.timedelta(seconds=settings.LUTEFISK_EMAIL_OUTBOX_LEASE_SECONDS)
+        expiration_days = datetime.timedelta(days=settings.LUTEFISK_ACTIVATION_DAYS)
+        sent = 0
+        while True:
+            pks = list(self.get_activation_reminders().order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+
+            # The claim repeats the conditions of the selection, so users
+            # that were activated or expired in the meantime are skipped.
+            claim = uuid.uuid4().hex
+            now = utils.get_datetime_now()
+            self.filter(pk__in=pks,
+                        activation_notification_send=False,
+                        user__is_active=False,
+                        user__date_joined__gt=now - expiration_days) \
+                .exclude(activation_key=settings.LUTEFISK_ACTIVATED) \
+                .filter(Q(activation_notification_claimed__isnull=True) |
+                        Q(activation_notification_claimed__lt=now - lease)) \
+                .update(activation_notification_claim=claim,
+                        activation_notification_claimed=now)
+
+            # Only the signups claimed by this run are sent.
+            signups = self.select_related('user').filter(activation_notification_claim=claim)
+            contexts = [signup.get_activation_reminder_context()
+                        for signup in signups.iterator()]
+            user_languages = self.get_languages([context['user'].pk for context in contexts])
+            languages = [user_languages.get(context['user'].pk) for context in contexts]
+            subjects = rendering.render_many('lutefisk/emails/activation_reminder_subject.txt',
+                                             contexts, languages)
+            bodies = rendering.render_many('lutefisk/emails/activation_reminder_message.txt',
+                                           contexts, languages)
+            messages = [mail.EmailMessage(''.join(subject.splitlines()),
+                                          body,
+                                          settings.DEFAULT_FROM_EMAIL,
+                                          [context['user'].email,],
+                                          connection=connection)
+                        for context, subject, body in zip(contexts, subjects, bodies)]
+            if messages:
+                with instrumentation.timer('smtp'):
+                    connection.send_messages(messages)
+
+            self.filter(activation_notification_claim=claim) \
+                .update(activation_notification_send=True,
+                        activation_notification_claim='',
+                        activation_notification_claimed=None)
+            sent += len(messages)
+        return sent
+
+    def get_languages(self, user_ids):
+        """
+        Returns the languages of the profiles of many users with a single
+        query.
+
+        :param user_ids:
+        List of user ids.
+
+        :return: Dictionary mapping user ids to languages. Users without a
+        profile or language are left out.
+
+        """
+        try:
+            profile_model = utils.get_profile_model()
+        except SiteProfileNotAvailable:
+            return {}
+
+        field = settings.LUTEFISK_LANGUAGE_FIELD
+        if not user_ids or field not in [f.name for f in profile_model._meta.fields]:
+            return {}
+
+        profiles = profile_model.objects.filter(user__in=user_ids).values_list('user', field)
+        return dict((user_id, language) for user_id, language in profiles if language)
+
     def create_lutefisk_profile(self, user):
         """
         Creates an :class:`LutefiskSignup` instance for this user.
@@ -79,8 +360,35 @@ class LutefiskManager(UserManager):
             user.username = user.username.encode('utf-8')
         salt, activation_key = utils.generate_sha1(user.username)
 
-        return self.create(user=user, activation_key=activation_key)
+        return self.create(user=user,
+                           activation_key=activation_key,
+                           email_lower=utils.normalize_identification(user.email),
+                           username_lower=utils.normalize_identification(user.username))
+
+    def is_email_available(self, email):
+        """
+        Checks if no signup uses an email address.
+
+        With ``LUTEFISK_EMAIL_FILTER`` addresses that were never used are
+        recognized by an in-memory Bloom filter without a query. Other
+        addresses are checked with an existence query on the indexed
+        ``email_lower`` column.
+
+        :param email:
+        String containing the email address.
 
+        :return: ``True`` if the email address is available.
+
+        """
+        email_lower = utils.normalize_identification(email)
+        if not email_lower:
+            return False
+        if settings.LUTEFISK_EMAIL_FILTER and not email_filter.might_contain(email_lower):
+            return True
+        with routers.replica():
+            return not self.filter(email_lower=email_lower).exists()
+
+    @instrumented('manager.activate_user')
     def activate_user(self, username, activation_key):
         """
         Activate an :class:`User` by supplying a valid ``activation_key``.
@@ -88,6 +396,12 @@ class LutefiskManager(UserManager):
         If the key is valid and an user is found, activates the user and
         return it. Also sends the ``activation_complete`` signal.
 
+        Activation takes three statements: a ``SELECT`` of the signup and
+        its user, a conditional ``UPDATE`` of the activation key and an
+        ``UPDATE`` of ``is_active``, see :meth:`_activate`. Expired and
+        already used keys are filtered out by the ``SELECT`` and again by
+        the conditional ``UPDATE``.
+
         :param username:
         String containing the username that wants to be activated.
 
@@ -99,31 +413,93 @@ class LutefiskManager(UserManager):
 
         """
         if SHA1_RE.search(activation_key):
+            expiration_days = datetime.timedelta(days=settings.LUTEFISK_ACTIVATION_DAYS)
             try:
-                lutefisk = self.get(user__username=username,
-                                    activation_key=activation_key)
+                lutefisk = self.select_related('user').get(user__username=username,
+                                                           user__date_joined__gt=utils.get_datetime_now() - expiration_days,
+                                                           activation_key=activation_key)
             except self.model.DoesNotExist:
                 return False
-            if not lutefisk.activation_key_expired():
-                lutefisk.activation_key = settings.LUTEFISK_ACTIVATED
-                user = lutefisk.user
-                user.is_active = True
-                lutefisk.save(using=self._db)
-                user.save(using=self._db)
+            return self._activate(lutefisk)
+        return False
 
-                signals.activation_complete.send(sender=None, user=user)
+    @instrumented('manager.activate_user_token')
+    def activate_user_token(self, token):
+        """
+        Activate an :class:`User` by supplying a signed activation token.
 
-                return user
-        return False
+        Tokens with a bad signature or that are older than
+        ``LUTEFISK_ACTIVATION_DAYS`` are rejected without a query. See
+        :class:`LutefiskTokenGenerator`.
+
+        :param token:
+        String containing the token from the activation email.
+
+        :return:
+        The newly activated :class:`User` or ``False`` if not successful.
+
+        """
+        checked = default_token_generator.check_token(token, 'activation',
+                                                      settings.LUTEFISK_ACTIVATION_DAYS)
+        if checked is None:
+            return False
 
+        user_id, timestamp = checked
+        try:
+            lutefisk = self.select_related('user').get(user__pk=user_id)
+        except self.model.DoesNotExist:
+            return False
+
+        if lutefisk.activation_key == settings.LUTEFISK_ACTIVATED:
+            return False
+        if get_timestamp(lutefisk.user.date_joined) != timestamp:
+            return False
+        return self._activate(lutefisk)
+
+    def _activate(self, lutefisk):
+        """
+        Activates the user of a valid :class:`LutefiskSignup`.
+
+        The activation key is replaced with a conditional ``UPDATE`` that
+        only matches the key that was loaded and a user that joined less
+        than ``LUTEFISK_ACTIVATION_DAYS`` ago. Of two concurrent clicks on
+        the same link only one activates the user, and a key that expired
+        after it was loaded isn't used. A second ``UPDATE`` sets
+        ``is_active``; only the changed columns are written.
+
+        :return: The activated :class:`User` or ``False`` if the key was
+        used or expired in the meantime.
+
+        """
+        user = lutefisk.user
+        expiration_days = datetime.timedelta(days=settings.LUTEFISK_ACTIVATION_DAYS)
+        with transaction.commit_on_success(using=self._db):
+            if not self.filter(pk=lutefisk.pk,
+                               activation_key=lutefisk.activation_key,
+                               user__date_joined__gt=utils.get_datetime_now() - expiration_days) \
+                    .update(activation_key=settings.LUTEFISK_ACTIVATED):
+                return False
+            User.objects.using(self._db).filter(pk=user.pk).update(is_active=True)
+
+        lutefisk.activation_key = settings.LUTEFISK_ACTIVATED
+        user.is_active = True
+        utils.forget_cached_user(user.pk)
+        bump_profile_version(user.pk)
+
+        dispatch.send(signals.activation_complete, user=user)
+
+        return user
+
+    @instrumented('manager.confirm_email')
     def confirm_email(self, username, confirmation_key):
         """
         Confirm an email address by checking a ``confirmation_key``.
 
         A valid ``confirmation_key`` will set the newly wanted e-mail
         address as the current e-mail address. Returns the user after
-        success or ``False`` when the confirmation key is
-        invalid. Also sends the ``confirmation_complete`` signal.
+        success or ``False`` when the confirmation key is invalid or older
+        than ``LUTEFISK_EMAIL_CONFIRMATION_DAYS``. Also sends the
+        ``confirmation_complete`` signal.
 
         :param username:
         String containing the username of the user that wants their email
@@ -137,25 +513,106 @@ class LutefiskManager(UserManager):
 
         """
         if SHA1_RE.search(confirmation_key):
+            confirmation_days = datetime.timedelta(days=settings.LUTEFISK_EMAIL_CONFIRMATION_DAYS)
             try:
-                lutefisk = self.get(user__username=username,
-                                    email_confirmation_key=confirmation_key,
-                                    email_unconfirmed__isnull=False)
+                lutefisk = self.select_related('user').get(user__username=username,
+                                                           email_confirmation_key=confirmation_key,
+                                                           email_confirmation_key_created__gt=utils.get_datetime_now() - confirmation_days,
+                                                           email_unconfirmed__isnull=False)
             except self.model.DoesNotExist:
                 return False
             else:
-                user = lutefisk.user
-                old_email = user.email
-                user.email = lutefisk.email_unconfirmed
-                lutefisk.email_unconfirmed, lutefisk.email_confirmation_key = '',''
-                lutefisk.save(using=self._db)
-                user.save(using=self._db)
+                return self._confirm_email(lutefisk)
+        return False
+
+    @instrumented('manager.confirm_email_token')
+    def confirm_email_token(self, user_id, token):
+        """
+        Confirm an email address by checking a signed confirmation token.
 
-                signals.confirmation_complete.send(sender=None, user=user, old_email=old_email)
+        Tokens with a bad signature, for another user or that are older than
+        ``LUTEFISK_EMAIL_CONFIRMATION_DAYS`` are rejected without a query.
+        See :class:`LutefiskTokenGenerator`.
 
-                return user
-        return False
+        :param user_id:
+        The primary key of the user that wants their email verified.
 
+        :param token:
+        String containing the token from the confirmation email.
+
+        :return:
+        The verified :class:`User` or ``False`` if not successful.
+
+        """
+        checked = default_token_generator.check_token(token, 'confirmation',
+                                                      settings.LUTEFISK_EMAIL_CONFIRMATION_DAYS)
+        if checked is None or checked[0] != user_id:
+            return False
+
+        user_id, timestamp = checked
+        try:
+            lutefisk = self.select_related('user').get(user__pk=user_id)
+        except self.model.DoesNotExist:
+            return False
+
+        if not lutefisk.email_unconfirmed or not lutefisk.email_confirmation_key_created:
+            return False
+        if get_timestamp(lutefisk.email_confirmation_key_created) != timestamp:
+            return False
+        return self._confirm_email(lutefisk)
+
+    def _confirm_email(self, lutefisk):
+        """
+        Confirms the new email address of a valid :class:`LutefiskSignup`.
+
+        The pending change is cleared with a conditional ``UPDATE`` that
+        only matches the confirmation key that was loaded, so a confirmation
+        can't be applied twice or overwrite a newer change. Only the changed
+        columns of the signup and the user are written.
+
+        The new address is checked again inside the transaction, because
+        someone else may have signed up with it after the change was
+        requested. The unique ``email_lower`` column catches the remaining
+        race.
+
+        :return: The :class:`User` or ``False`` if the key was used or
+        replaced in the meantime, or if the address was taken.
+
+        """
+        user = lutefisk.user
+        old_email = user.email
+        new_email = lutefisk.email_unconfirmed
+        email_lower = utils.normalize_identification(new_email)
+
+        try:
+            with transaction.commit_on_success(using=self._db):
+                if self.filter(email_lower=email_lower).exclude(pk=lutefisk.pk).exists():
+                    return False
+                if not self.filter(pk=lutefisk.pk,
+                                   email_confirmation_key=lutefisk.email_confirmation_key) \
+                        .update(email_lower=email_lower,
+                                email_changed=utils.get_datetime_now(),
+                                email_unconfirmed='',
+                                email_confirmation_key=''):
+                    return False
+                lutefisk.email_lower = email_lower
+                lutefisk.email_unconfirmed, lutefisk.email_confirmation_key = '', ''
+                user._lutefisk_signup_cache = lutefisk
+                # The signup is up to date, sync_identification can skip it.
+                user._lutefisk_identification = (email_lower,
+                                                 utils.normalize_identification(user.username))
+                user.email = new_email
+                utils.update_fields(user, ['email'], using=self._db)
+        except IntegrityError:
+            # Someone else took the address in the meantime.
+            user.email = old_email
+            return False
+
+        dispatch.send(signals.confirmation_complete, user=user, old_email=old_email)
+
+        return user
+
+    @instrumented('manager.delete_expired_users')
     def delete_expired_users(self):
         """
         Checks for expired users and delete's the ``User`` associated with
@@ -171,6 +628,399 @@ class LutefiskManager(UserManager):
                 user.delete()
         return deleted_users
 
+    def get_expired_users(self):
+        """
+        Returns a queryset of users whose activation period has passed.
+
+        The expiry rule is the same as :func:`activation_key_expired` but is
+        evaluated by the database from ``date_joined`` and
+        ``LUTEFISK_ACTIVATION_DAYS``, so no :class:`LutefiskSignup` has to be
+        loaded. Users that are ``is_staff`` are never included.
+
+        :return: A :class:`User` queryset.
+
+        """
+        expiration_days = datetime.timedelta(days=settings.LUTEFISK_ACTIVATION_DAYS)
+        expiration_date = utils.get_datetime_now() - expiration_days
+
+        users = User.objects.using(self._db).filter(is_staff=False,
+                                                    is_active=False,
+                                                    lutefisk_signup__isnull=False)
+        return users.filter(Q(date_joined__lte=expiration_date) |
+                            Q(lutefisk_signup__activation_key=settings.LUTEFISK_ACTIVATED))
+
+    @instrumented('manager.purge_expired_users')
+    def purge_expired_users(self, batch_size=1000, max_seconds=None,
+                            dry_run=False):
+        """
+        Deletes expired users in primary key ordered chunks.
+
+        Every chunk is deleted in its own transaction so that locks are held
+        only briefly and a long sweep can be interrupted without losing the
+        work that was already done. Users that are no longer expired when
+        their chunk is deleted are skipped.
+
+        :param batch_size:
+        Integer with the maximum number of users deleted per chunk.
+
+        :param max_seconds:
+        Optional number of seconds after which no new chunk is started.
+
+        :param dry_run:
+        Boolean that defines if the expired users should only be counted.
+
+        :return: Integer with the number of (would be) deleted users.
+
+        """
+        users = self.get_expired_users()
+
+        if dry_run:
+            return users.count()
+
+        started = time.time()
+        deleted = 0
+        last_pk = 0
+        while True:
+            if max_seconds is not None and time.time() - started >= max_seconds:
+                break
+
+            pks = list(users.filter(pk__gt=last_pk).order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+
+            # The delete repeats the expiry condition, so a user that is
+            # activated during the sweep is left alone.
+            with transaction.commit_on_success(using=self._db):
+                chunk = users.filter(pk__in=pks)
+                deleted += chunk.count()
+                chunk.delete()
+            last_pk = pks[-1]
+        return deleted
+
+    def get_expired_email_confirmations(self):
+        """
+        Returns the pending email changes that are older than
+        ``LUTEFISK_EMAIL_CONFIRMATION_DAYS`` and can no longer be confirmed.
+
+        :return: A :class:`LutefiskSignup` queryset.
+
+        """
+        confirmation_days = datetime.timedelta(days=settings.LUTEFISK_EMAIL_CONFIRMATION_DAYS)
+        expiration_date = utils.get_datetime_now() - confirmation_days
+
+        pending = self.exclude(email_confirmation_key='')
+        return pending.filter(Q(email_confirmation_key_created__lte=expiration_date) |
+                              Q(email_confirmation_key_created__isnull=True))
+
+    @instrumented('manager.purge_expired_email_confirmations')
+    def purge_expired_email_confirmations(self, batch_size=1000, max_seconds=None,
+                                          dry_run=False):
+        """
+        Clears expired pending email changes in primary key ordered chunks.
+
+        Every chunk is cleared with a single ``UPDATE`` in its own
+        transaction. The ``UPDATE`` repeats the expiry condition, so a change
+        that is requested again during the sweep is left alone.
+
+        :param batch_size:
+        Integer with the maximum number of signups updated per chunk.
+
+        :param max_seconds:
+        Optional number of seconds after which no new chunk is started.
+
+        :param dry_run:
+        Boolean that defines if the expired changes should only be counted.
+
+        :return: Integer with the number of (would be) cleared changes.
+
+        """
+        expired = self.get_expired_email_confirmations()
+
+        if dry_run:
+            return expired.count()
+
+        started = time.time()
+        cleared = 0
+        last_pk = 0
+        while True:
+            if max_seconds is not None and time.time() - started >= max_seconds:
+                break
+
+            pks = list(expired.filter(pk__gt=last_pk).order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+
+            with transaction.commit_on_success(using=self._db):
+                cleared += expired.filter(pk__in=pks).update(email_unconfirmed='',
+                                                             email_confirmation_key='',
+                                                             email_confirmation_key_created=None)
+            last_pk = pks[-1]
+        return cleared
+
+
+class LutefiskMailManager(models.Manager):
+    """ Manager for :class:`LutefiskMail`, the lutefisk email outbox. """
+
+    def send_mail(self, subject, message, from_email, recipient_list):
+        """
+        Sends an email or stores it in the outbox.
+
+        When ``LUTEFISK_EMAIL_OUTBOX`` is ``False`` the email is sent right
+        away with Django's :func:`send_mail`, otherwise it is queued for the
+        ``deliver_mail`` management command.
+
+        :return: The queued :class:`LutefiskMail` or ``None`` if it was sent.
+
+        """
+        if not settings.LUTEFISK_EMAIL_OUTBOX:
+            with instrumentation.timer('smtp'):
+                mail.send_mail(subject, message, from_email, recipient_list)
+            return None
+        return self.enqueue(subject, message, from_email, recipient_list)
+
+    def enqueue(self, subject, message, from_email, recipient_list):
+        """
+        Stores an email in the outbox.
+
+        :return: The newly created :class:`LutefiskMail` instance.
+
+        """
+        return self.create(subject=subject,
+                           message=message,
+                           from_email=from_email,
+                           recipients='\n'.join(recipient_list))
+
+    def get_pending(self):
+        """ Returns the emails that are due for a delivery attempt. """
+        now = utils.get_datetime_now()
+        return self.filter(status='pending', next_attempt__lte=now).filter(
+            Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+
+    def queue_depth(self):
+        """ Returns the number of emails that still have to be delivered. """
+        return self.filter(status='pending').count()
+
+    def claim(self, batch_size=100):
+        """
+        Claims a batch of pending emails for this worker.
+
+        The emails are marked with a unique claim with a conditional
+        ``UPDATE``, so concurrent workers never deliver the same email. A
+        claim expires after ``LUTEFISK_EMAIL_OUTBOX_LEASE_SECONDS`` so that
+        emails of a crashed worker are picked up again.
+
+        :param batch_size:
+        Integer with the maximum number of emails to claim.
+
+        :return: A list of claimed :class:`LutefiskMail` instances.
+
+        """
+        pks = list(self.get_pending().order_by('next_attempt', 'pk')
+                   .values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return []
+
+        claim = uuid.uuid4().hex
+        lease = datetime.timedelta(seconds=settings.LUTEFISK_EMAIL_OUTBOX_LEASE_SECONDS)
+        self.get_pending().filter(pk__in=pks).update(claim=claim,
+                                                     claimed_until=utils.get_datetime_now() + lease)
+        return list(self.filter(claim=claim, status='pending').order_by('pk'))
+
+    @instrumented('manager.deliver')
+    def deliver(self, batch_size=100, connection=None):
+        """
+        Delivers one batch of pending emails over a single connection.
+
+        Failed emails are retried with an exponential backoff starting at
+        ``LUTEFISK_EMAIL_OUTBOX_RETRY_SECONDS`` until
+        ``LUTEFISK_EMAIL_OUTBOX_MAX_ATTEMPTS`` is reached.
+
+        :param batch_size:
+        Integer with the maximum number of emails to deliver.
+
+        :param connection:
+        Optional email backend connection. Defaults to
+        :func:`get_connection`.
+
+        :return: Tuple containing the number of sent and failed emails.
+
+        """
+        messages = self.claim(batch_size)
+        if not messages:
+            return 0, 0
+
+        if connection is None:
+            connection = mail.get_connection()
+
+        sent, failed = [], 0
+        connection.open()
+        try:
+            for message in messages:
+                email = mail.EmailMessage(message.subject,
+                                          message.message,
+                                          message.from_email,
+                                          message.get_recipient_list(),
+                                          connection=connection)
+                try:
+                    with instrumentation.timer('smtp'):
+                        email.send()
+                except Exception, e:
+                    failed += 1
+                    self._retry(message, e)
+                else:
+                    sent.append(message.pk)
+        finally:
+            connection.close()
+
+        if sent:
+            self.filter(pk__in=sent).update(status='sent',
+                                            claim='',
+                                            claimed_until=None)
+        return len(sent), failed
+
+    def _retry(self, message, error):
+        """ Releases a failed email and schedules the next attempt. """
+        attempts = message.attempts + 1
+        delay = settings.LUTEFISK_EMAIL_OUTBOX_RETRY_SECONDS * 2 ** (attempts - 1)
+        if attempts >= settings.LUTEFISK_EMAIL_OUTBOX_MAX_ATTEMPTS:
+            status = 'failed'
+        else:
+            status = 'pending'
+        self.filter(pk=message.pk).update(status=status,
+                                          attempts=attempts,
+                                          next_attempt=utils.get_datetime_now() + datetime.timedelta(seconds=delay),
+                                          claim='',
+                                          claimed_until=None,
+                                          last_error=unicode(error))
+
+
+class LutefiskEventManager(models.Manager):
+    """ Manager for :class:`LutefiskEvent`, the deferred signal queue. """
+
+    def enqueue(self, signal, payload):
+        """
+        Stores a signal for the ``dispatch_signals`` command.
+
+        :return: The newly created :class:`LutefiskEvent` instance.
+
+        """
+        return self.create(signal=signal, payload=payload)
+
+    def get_pending(self):
+        """ Returns the events that are due for a dispatch attempt. """
+        now = utils.get_datetime_now()
+        return self.filter(status='pending', next_attempt__lte=now).filter(
+            Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+
+    def queue_depth(self):
+        """ Returns the number of events that still have to be dispatched. """
+        return self.filter(status='pending').count()
+
+    def claim(self, batch_size=100):
+        """
+        Claims a batch of pending events for this worker, like
+        :func:`LutefiskMailManager.claim`.
+
+        :return: A list of claimed :class:`LutefiskEvent` instances.
+
+        """
+        pks = list(self.get_pending().order_by('next_attempt', 'pk')
+                   .values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return []
+
+        claim = uuid.uuid4().hex
+        lease = datetime.timedelta(seconds=settings.LUTEFISK_SIGNAL_LEASE_SECONDS)
+        self.get_pending().filter(pk__in=pks).update(claim=claim,
+                                                     claimed_until=utils.get_datetime_now() + lease)
+        return list(self.filter(claim=claim, status='pending').order_by('pk'))
+
+    def dispatch(self, batch_size=100):
+        """
+        Runs the receivers of one batch of pending events.
+
+        Events whose receivers fail are retried with an exponential backoff
+        starting at ``LUTEFISK_SIGNAL_RETRY_SECONDS`` until
+        ``LUTEFISK_SIGNAL_MAX_ATTEMPTS`` is reached. A retry runs all
+        receivers of the signal again.
+
+        :param batch_size:
+        Integer with the maximum number of events to dispatch.
+
+        :return: Tuple containing the number of dispatched and failed events.
+
+        """
+        events = self.claim(batch_size)
+
+        done, failed = [], 0
+        for event in events:
+            try:
+                errors = dispatch.run(event.signal, dispatch.deserialize(event.payload))
+            except Exception, e:
+                errors = [e]
+            if errors:
+                failed += 1
+                self._retry(event, errors[0])
+            else:
+                done.append(event.pk)
+
+        if done:
+            self.filter(pk__in=done).update(status='done',
+                                            claim='',
+                                            claimed_until=None)
+        return len(done), failed
+
+    def _retry(self, event, error):
+        """ Releases a failed event and schedules the next attempt. """
+        attempts = event.attempts + 1
+        delay = settings.LUTEFISK_SIGNAL_RETRY_SECONDS * 2 ** (attempts - 1)
+        if attempts >= settings.LUTEFISK_SIGNAL_MAX_ATTEMPTS:
+            status = 'failed'
+        else:
+            status = 'pending'
+        self.filter(pk=event.pk).update(status=status,
+                                        attempts=attempts,
+                                        next_attempt=utils.get_datetime_now() + datetime.timedelta(seconds=delay),
+                                        claim='',
+                                        claimed_until=None,
+                                        last_error=unicode(error))
+
+
+class LutefiskSequenceManager(models.Manager):
+    """ Manager for :class:`LutefiskSequence`. """
+
+    def reserve(self, name, count=1):
+        """
+        Reserves a block of numbers from a named sequence.
+
+        The sequence is incremented with a single ``UPDATE`` and read back in
+        the same transaction, so concurrent callers always get disjoint
+        blocks. The sequence is created on first use.
+
+        :param name:
+        String containing the name of the sequence.
+
+        :param count:
+        Integer with the size of the block to reserve.
+
+        :return: Tuple containing the first and last reserved number.
+
+        """
+        for attempt in range(2):
+            try:
+                with transaction.commit_on_success(using=self._db):
+                    if not self.filter(name=name).update(value=F('value') + count):
+                        self.create(name=name, value=count)
+                    last = self.filter(name=name).values_list('value', flat=True)[0]
+            except IntegrityError:
+                # Someone else created the sequence first, try again.
+                if attempt:
+                    raise
+            else:
+                return last - count + 1, last
+
 
 class LutefiskBaseProfileManager(models.Manager):
     """ Manager for :class:`LutefiskProfile` """
@@ -185,21 +1035,88 @@ class LutefiskBaseProfileManager(models.Manager):
         :param user:
         A Django :class:`User` instance.
 
+        The profiles are read from a replica when
+        ``LUTEFISK_READ_REPLICAS`` are configured, see :func:`get_replica`.
+
         :return:
         All profiles that are visible to this user.
 
         """
-        profiles = self.all()
+        profiles = self.select_related('user').using(routers.get_replica() or self._db)
 
         filter_kwargs = {'user__is_active': True}
 
         profiles = profiles.filter(**filter_kwargs)
         if user and isinstance(user, AnonymousUser):
-            profiles = profiles.exclude(Q(privacy='closed') | Q(privacy='registered'))
+            profiles = profiles.filter(privacy='open')
         else:
-            profiles = profiles.exclude(Q(privacy='closed'))
+            profiles = profiles.filter(privacy__in=('open', 'registered'))
         return profiles
 
+    @instrumented('manager.get_visible_profiles_page')
+    def get_visible_profiles_page(self, user=None, after=None, limit=None):
+        """
+        Returns a page of the visible profiles available to this user.
+
+        Uses keyset pagination: a page starts right after the primary key
+        ``after`` instead of skipping rows with an ``OFFSET``, so deep pages
+        cost as much as the first one. This needs an index on
+        ``(privacy, id)`` of the profile table, which the profile model of
+        the site has to create in one of its migrations, e.g. with South::
+
+            db.create_index('accounts_profile', ['privacy', 'id'])
+
+        :param user:
+        A Django :class:`User` instance.
+
+        :param after:
+        Optional primary key of the last profile of the previous page.
+
+        :param limit:
+        Optional number of profiles per page. Defaults to
+        ``LUTEFISK_PROFILE_PAGE_SIZE``.
+
+        :return:
+        Tuple containing the list of profiles and the ``after`` value of the
+        next page, which is ``None`` on the last page.
+
+        """
+        if limit is None:
+            limit = settings.LUTEFISK_PROFILE_PAGE_SIZE
+
+        profiles = self.get_visible_profiles(user).order_by('pk')
+        if after is not None:
+            profiles = profiles.filter(pk__gt=after)
+
+        profiles = list(profiles[:limit + 1])
+        if len(profiles) > limit:
+            return profiles[:limit], profiles[limit - 1].pk
+        return profiles, None
+
+    @instrumented('manager.count_visible_profiles')
+    def count_visible_profiles(self, user=None):
+        """
+        Returns the number of visible profiles available to this user.
+
+        The count is cached for ``LUTEFISK_PROFILE_COUNT_CACHE_TIMEOUT``
+        seconds, so it is only an approximation on busy sites.
+
+        :param user:
+        A Django :class:`User` instance.
+
+        """
+        if user and isinstance(user, AnonymousUser):
+            audience = 'anonymous'
+        else:
+            audience = 'registered'
+
+        cache_key = 'lutefisk:visible-profiles:%s:%s' % (self.model._meta.db_table, audience)
+        count = cache.get(cache_key)
+        if count is None:
+            count = self.get_visible_profiles(user).count()
+            cache.set(cache_key, count, settings.LUTEFISK_PROFILE_COUNT_CACHE_TIMEOUT)
+        return count
+
 # Local Variables:
 # indent-tabs-mode: nil
 # End:
@@ -1,8 +1,14 @@
 from django.utils import translation
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist, MiddlewareNotUsed
 from django.conf import settings
+from django.contrib.auth import SESSION_KEY
 from django.contrib.auth.models import SiteProfileNotAvailable
 
+from lutefisk import instrumentation
+from lutefisk import utils
+from lutefisk.activity import activity_buffer
+
 class LutefiskLocaleMiddleware(object):
     """
     Set the language by looking at the language setting in the profile.
@@ -10,19 +16,79 @@ class LutefiskLocaleMiddleware(object):
     It doesn't override the cookie that is set by Django so a user can still
     switch languages depending if the cookie is set.
 
+    The language is cached per user for ``LUTEFISK_LANGUAGE_CACHE_TIMEOUT``
+    seconds and refreshed whenever the profile is saved, so the profile is
+    only loaded on the first request.
+
     """
     def process_request(self, request):
         lang_cookie = request.session.get(settings.LANGUAGE_COOKIE_NAME)
         if not lang_cookie:
             if request.user.is_authenticated():
-                try:
-                    profile = request.user.get_profile()
-                except (ObjectDoesNotExist, SiteProfileNotAvailable):
-                    profile = False
-
-                if profile:
-                    try:
-                        lang = getattr(profile, g.LUTEFISK_LANGUAGE_FIELD)
-                        translation.activate(lang)
-                        request.LANGUAGE_CODE = translation.get_language()
-                    except AttributeError: pass
+                cache_key = utils.get_language_cache_key(request.user.pk)
+                lang = cache.get(cache_key)
+                if lang is None:
+                    lang = self.get_profile_language(request.user)
+                    cache.set(cache_key, lang, settings.LUTEFISK_LANGUAGE_CACHE_TIMEOUT)
+
+                if lang:
+                    translation.activate(lang)
+                    request.LANGUAGE_CODE = translation.get_language()
+
+    def get_profile_language(self, user):
+        """
+        Returns the language of the profile of ``user`` or an empty string
+        when there is none.
+
+        """
+        try:
+            profile = user.get_profile()
+        except (ObjectDoesNotExist, SiteProfileNotAvailable):
+            return ''
+        return getattr(profile, settings.LUTEFISK_LANGUAGE_FIELD, '') or ''
+
+class LutefiskLastActiveMiddleware(object):
+    """
+    Keep ``LutefiskSignup.last_active`` up to date.
+
+    Activity is collected by :class:`ActivityBuffer` and written in bulk
+    when the buffer is full or ``LUTEFISK_LAST_ACTIVE_FLUSH_SECONDS`` have
+    passed, instead of with an ``UPDATE`` on every request. The user id
+    is read from the session so the user itself is never loaded. Idle
+    processes write their activity from a timer and at exit; a process
+    that is killed loses at most ``LUTEFISK_LAST_ACTIVE_FLUSH_SECONDS`` of
+    activity, see :class:`ActivityBuffer`.
+
+    """
+    def process_response(self, request, response):
+        session = getattr(request, 'session', None)
+        if session is not None:
+            user_id = session.get(SESSION_KEY)
+            if user_id:
+                activity_buffer.touch(user_id)
+                if activity_buffer.should_flush():
+                    activity_buffer.flush()
+        return response
+
+class LutefiskInstrumentationMiddleware(object):
+    """
+    Collect the timings and query counts of every request.
+
+    The report is named after the view and published through the
+    ``instrumentation_report`` signal and the sinks in
+    ``LUTEFISK_INSTRUMENTATION_SINKS`` once the response is ready. The
+    middleware removes itself when ``LUTEFISK_INSTRUMENTATION`` is
+    ``False``, so it costs nothing when turned off.
+
+    """
+    def __init__(self):
+        if not settings.LUTEFISK_INSTRUMENTATION:
+            raise MiddlewareNotUsed
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        name = getattr(view_func, '__name__', view_func.__class__.__name__)
+        instrumentation.start('%s.%s' % (view_func.__module__, name))
+
+    def process_response(self, request, response):
+        instrumentation.finish()
+        return response
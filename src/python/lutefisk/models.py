@@ -1,15 +1,21 @@
 from django.db import models
+from django.db.models.signals import post_init, post_save, post_delete
+from django.core.cache import cache
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User
-from django.template.loader import render_to_string
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
-from django.core.mail import send_mail
 from django.core.exceptions import ImproperlyConfigured
 
-from lutefisk.utils import generate_sha1, get_protocol, get_datetime_now
-from lutefisk.managers import LutefiskManager, LutefiskBaseProfileManager
+from lutefisk.utils import generate_sha1, get_protocol, get_datetime_now, get_language_cache_key, \
+    forget_cached_user, normalize_identification, update_fields, CachedUser
+from lutefisk.managers import LutefiskManager, LutefiskBaseProfileManager, LutefiskMailManager, \
+    LutefiskSequenceManager, LutefiskEventManager
+from lutefisk.fragments import bump_profile_version
+from lutefisk.instrumentation import instrumented
+from lutefisk.rendering import render_to_string
+from lutefisk.tokens import default_token_generator
 
 import datetime, random
 
@@ -35,19 +41,53 @@ class LutefiskSignup(models.Model):
 
     activation_notification_send = models.BooleanField(_('notification send'),
                                                        default=False,
+                                                       db_index=True,
                                                        help_text=_('Designates whether this user has already got a notification about activating their account.'))
 
+    activation_notification_claim = models.CharField(_('notification claim'),
+                                                     max_length=32,
+                                                     blank=True,
+                                                     db_index=True,
+                                                     help_text=_('Identifies the worker that is sending the activation notification.'))
+
+    activation_notification_claimed = models.DateTimeField(_('notification claimed'),
+                                                           blank=True,
+                                                           null=True)
+
     email_unconfirmed = models.EmailField(_('unconfirmed email address'),
                                           blank=True,
                                           help_text=_('Temporary email address when the user requests an email change.'))
 
     email_confirmation_key = models.CharField(_('unconfirmed email verification key'),
                                               max_length=40,
-                                              blank=True)
+                                              blank=True,
+                                              db_index=True)
 
     email_confirmation_key_created = models.DateTimeField(_('creation date of email confirmation key'),
                                                           blank=True,
-                                                          null=True)
+                                                          null=True,
+                                                          db_index=True)
+
+    email_lower = models.CharField(_('normalized email address'),
+                                   max_length=75,
+                                   blank=True,
+                                   null=True,
+                                   unique=True,
+                                   help_text=_('Lower-cased email address used for case-insensitive lookups.'))
+
+    email_changed = models.DateTimeField(_('email changed'),
+                                         blank=True,
+                                         null=True,
+                                         default=get_datetime_now,
+                                         db_index=True,
+                                         help_text=_('The last date that the email address was set.'))
+
+    username_lower = models.CharField(_('normalized username'),
+                                      max_length=30,
+                                      blank=True,
+                                      null=True,
+                                      unique=True,
+                                      help_text=_('Lower-cased username used for case-insensitive lookups.'))
 
 
     objects = LutefiskManager()
@@ -59,6 +99,7 @@ class LutefiskSignup(models.Model):
     def __unicode__(self):
         return '%s' % self.user.username
 
+    @instrumented('model.change_email')
     def change_email(self, email):
         """
         Changes the email address for a user.
@@ -78,11 +119,14 @@ class LutefiskSignup(models.Model):
         salt, hash = generate_sha1(self.user.username)
         self.email_confirmation_key = hash
         self.email_confirmation_key_created = get_datetime_now()
-        self.save()
+        update_fields(self, ['email_unconfirmed',
+                             'email_confirmation_key',
+                             'email_confirmation_key_created'])
 
         # Send email for activation
         self.send_confirmation_email()
 
+    @instrumented('model.send_confirmation_email')
     def send_confirmation_email(self):
         """
         Sends an email to confirm the new email address.
@@ -102,6 +146,11 @@ class LutefiskSignup(models.Model):
                   'confirmation_key': self.email_confirmation_key,
                   'site': Site.objects.get_current()}
 
+        if settings.LUTEFISK_SIGNED_TOKENS:
+            context['confirmation_token'] = default_token_generator.make_token(self.user_id,
+                                                                              'confirmation',
+                                                                              self.email_confirmation_key_created)
+
 
         # Email to the old address
         subject_old = render_to_string('lutefisk/emails/confirmation_email_subject_old.txt',
@@ -111,10 +160,10 @@ class LutefiskSignup(models.Model):
         message_old = render_to_string('lutefisk/emails/confirmation_email_message_old.txt',
                                        context)
 
-        send_mail(subject_old,
-                  message_old,
-                  settings.DEFAULT_FROM_EMAIL,
-                  [self.user.email])
+        LutefiskMail.objects.send_mail(subject_old,
+                                       message_old,
+                                       settings.DEFAULT_FROM_EMAIL,
+                                       [self.user.email])
 
         # Email to the new address
         subject_new = render_to_string('lutefisk/emails/confirmation_email_subject_new.txt',
@@ -124,10 +173,10 @@ class LutefiskSignup(models.Model):
         message_new = render_to_string('lutefisk/emails/confirmation_email_message_new.txt',
                                        context)
 
-        send_mail(subject_new,
-                  message_new,
-                  settings.DEFAULT_FROM_EMAIL,
-                  [self.email_unconfirmed,])
+        LutefiskMail.objects.send_mail(subject_new,
+                                       message_new,
+                                       settings.DEFAULT_FROM_EMAIL,
+                                       [self.email_unconfirmed,])
 
     def activation_key_expired(self):
         """
@@ -149,13 +198,18 @@ class LutefiskSignup(models.Model):
             return True
         return False
 
-    def send_activation_email(self):
+    @instrumented('model.send_activation_email')
+    def send_activation_email(self, defer=False):
         """
         Sends a activation email to the user.
 
         This email is send when the user wants to activate their newly created
         user.
 
+        :param defer:
+        Boolean that defines if the email should always be stored in the
+        outbox, regardless of ``LUTEFISK_EMAIL_OUTBOX``.
+
         """
         context= {'user': self.user,
                   'without_usernames': settings.LUTEFISK_WITHOUT_USERNAMES,
@@ -164,17 +218,201 @@ class LutefiskSignup(models.Model):
                   'activation_key': self.activation_key,
                   'site': Site.objects.get_current()}
 
+        if settings.LUTEFISK_SIGNED_TOKENS:
+            context['activation_token'] = default_token_generator.make_token(self.user_id,
+                                                                            'activation',
+                                                                            self.user.date_joined)
+
         subject = render_to_string('lutefisk/emails/activation_email_subject.txt',
                                    context)
         subject = ''.join(subject.splitlines())
 
         message = render_to_string('lutefisk/emails/activation_email_message.txt',
                                    context)
+        if defer:
+            send_mail = LutefiskMail.objects.enqueue
+        else:
+            send_mail = LutefiskMail.objects.send_mail
         send_mail(subject,
                   message,
                   settings.DEFAULT_FROM_EMAIL,
                   [self.user.email,])
 
+    def get_activation_reminder_context(self):
+        """
+        Returns the template context of the email that reminds the user to
+        activate their account.
+
+        The email itself is rendered and sent in bulk by
+        :func:`LutefiskManager.send_activation_reminders`.
+
+        """
+        expiration_date = self.user.date_joined + datetime.timedelta(days=settings.LUTEFISK_ACTIVATION_DAYS)
+        context= {'user': self.user,
+                  'without_usernames': settings.LUTEFISK_WITHOUT_USERNAMES,
+                  'protocol': get_protocol(),
+                  'expiration_date': expiration_date,
+                  'activation_key': self.activation_key,
+                  'site': Site.objects.get_current()}
+
+        if settings.LUTEFISK_SIGNED_TOKENS:
+            context['activation_token'] = default_token_generator.make_token(self.user_id,
+                                                                            'activation',
+                                                                            self.user.date_joined)
+        return context
+
+class LutefiskMail(models.Model):
+    """
+    An email waiting in the lutefisk outbox.
+
+    When ``LUTEFISK_EMAIL_OUTBOX`` is enabled the request path only stores
+    the emails in this table. They are delivered later by the
+    ``deliver_mail`` management command.
+
+    """
+    STATUS_CHOICES = (
+        ('pending', _('Pending')),
+        ('sent', _('Sent')),
+        ('failed', _('Failed')),
+        )
+
+    subject = models.CharField(_('subject'),
+                               max_length=255)
+
+    message = models.TextField(_('message'))
+
+    from_email = models.CharField(_('from email'),
+                                  max_length=255)
+
+    recipients = models.TextField(_('recipients'),
+                                  help_text=_('Email addresses separated by newlines.'))
+
+    status = models.CharField(_('status'),
+                              max_length=10,
+                              choices=STATUS_CHOICES,
+                              default='pending',
+                              db_index=True)
+
+    created = models.DateTimeField(_('created'),
+                                   default=get_datetime_now)
+
+    next_attempt = models.DateTimeField(_('next attempt'),
+                                        default=get_datetime_now,
+                                        db_index=True)
+
+    attempts = models.PositiveIntegerField(_('attempts'),
+                                           default=0)
+
+    claim = models.CharField(_('claim'),
+                             max_length=32,
+                             blank=True,
+                             db_index=True)
+
+    claimed_until = models.DateTimeField(_('claimed until'),
+                                         blank=True,
+                                         null=True)
+
+    last_error = models.TextField(_('last error'),
+                                  blank=True)
+
+    objects = LutefiskMailManager()
+
+    class Meta:
+        verbose_name = _('lutefisk email')
+        verbose_name_plural = _('lutefisk emails')
+
+    def __unicode__(self):
+        return '%s' % self.subject
+
+    def get_recipient_list(self):
+        """ Returns the recipients as a list of email addresses. """
+        return [r for r in self.recipients.splitlines() if r]
+
+class LutefiskEvent(models.Model):
+    """
+    A lutefisk signal waiting to be dispatched.
+
+    When ``LUTEFISK_SIGNAL_DISPATCH`` is ``queue`` the request path only
+    stores the signals in this table, right after the change that caused
+    them was committed. Their receivers are run later by the
+    ``dispatch_signals`` management command. A crash between the commit
+    and storing the signal loses it.
+
+    """
+    STATUS_CHOICES = (
+        ('pending', _('Pending')),
+        ('done', _('Done')),
+        ('failed', _('Failed')),
+        )
+
+    signal = models.CharField(_('signal'),
+                              max_length=50)
+
+    payload = models.TextField(_('payload'),
+                               help_text=_('Arguments of the signal as JSON.'))
+
+    status = models.CharField(_('status'),
+                              max_length=10,
+                              choices=STATUS_CHOICES,
+                              default='pending',
+                              db_index=True)
+
+    created = models.DateTimeField(_('created'),
+                                   default=get_datetime_now)
+
+    next_attempt = models.DateTimeField(_('next attempt'),
+                                        default=get_datetime_now,
+                                        db_index=True)
+
+    attempts = models.PositiveIntegerField(_('attempts'),
+                                           default=0)
+
+    claim = models.CharField(_('claim'),
+                             max_length=32,
+                             blank=True,
+                             db_index=True)
+
+    claimed_until = models.DateTimeField(_('claimed until'),
+                                         blank=True,
+                                         null=True)
+
+    last_error = models.TextField(_('last error'),
+                                  blank=True)
+
+    objects = LutefiskEventManager()
+
+    class Meta:
+        verbose_name = _('lutefisk event')
+        verbose_name_plural = _('lutefisk events')
+
+    def __unicode__(self):
+        return '%s' % self.signal
+
+class LutefiskSequence(models.Model):
+    """
+    A named counter from which blocks of numbers can be reserved.
+
+    Used by :class:`SequenceUsernameAllocator` to hand out usernames
+    without probing the user table.
+
+    """
+    name = models.CharField(_('name'),
+                            max_length=50,
+                            unique=True)
+
+    value = models.PositiveIntegerField(_('value'),
+                                        default=0,
+                                        help_text=_('The last number that was reserved.'))
+
+    objects = LutefiskSequenceManager()
+
+    class Meta:
+        verbose_name = _('lutefisk sequence')
+        verbose_name_plural = _('lutefisk sequences')
+
+    def __unicode__(self):
+        return '%s' % self.name
+
 class LutefiskBaseProfile(models.Model):
     """ Base model needed for extra profile functionality """
     PRIVACY_CHOICES = (
@@ -258,3 +496,103 @@ class LutefiskLanguageBaseProfile(LutefiskBaseProfile):
 
     class Meta:
         abstract = True
+
+def refresh_profile_language(sender, instance, **kwargs):
+    """
+    Refreshes the cached language of the user when their profile is saved.
+
+    """
+    if isinstance(instance, LutefiskBaseProfile):
+        lang = getattr(instance, settings.LUTEFISK_LANGUAGE_FIELD, '') or ''
+        cache.set(get_language_cache_key(instance.user_id), lang,
+                  settings.LUTEFISK_LANGUAGE_CACHE_TIMEOUT)
+
+def forget_profile_language(sender, instance, **kwargs):
+    """
+    Removes the cached language of the user when their profile is deleted.
+
+    """
+    if isinstance(instance, LutefiskBaseProfile):
+        cache.delete(get_language_cache_key(instance.user_id))
+
+def forget_user(sender, instance, **kwargs):
+    """
+    Removes the cached user when it is saved or deleted.
+
+    """
+    forget_cached_user(instance.pk)
+
+def remember_identification(sender, instance, **kwargs):
+    """
+    Remembers the normalized email address and username a user was loaded
+    with, so :func:`sync_identification` can skip saves that don't change
+    them without a query.
+
+    """
+    instance._lutefisk_identification = (normalize_identification(instance.email),
+                                         normalize_identification(instance.username))
+
+def sync_identification(sender, instance, created=False, raw=False, **kwargs):
+    """
+    Keeps the normalized email address and username of the signup up to
+    date when a user is saved outside of lutefisk, e.g. in the admin.
+
+    Users created outside of lutefisk get an activated signup, so every
+    user can be found through the indexed columns. Saves that don't change
+    the email address or username, like the ``last_login`` update on sign
+    in, return without a query. An email address or username that another
+    user already has raises ``IntegrityError``, like
+    :meth:`LutefiskManager.create_user`.
+
+    """
+    if raw or getattr(instance, '_lutefisk_signup_pending', False):
+        return
+
+    identification = (normalize_identification(instance.email),
+                      normalize_identification(instance.username))
+    loaded = getattr(instance, '_lutefisk_identification', (None, None))
+    if not created and identification == loaded:
+        return
+
+    email_lower, username_lower = identification
+    values = {'username_lower': username_lower}
+    if created or email_lower != loaded[0]:
+        values.update(email_lower=email_lower, email_changed=get_datetime_now())
+
+    using = kwargs.get('using')
+    if created or not LutefiskSignup.objects.using(using).filter(user=instance.pk).update(**values):
+        values.update(email_lower=email_lower)
+        LutefiskSignup.objects.using(using).create(user=instance,
+                                                   activation_key=settings.LUTEFISK_ACTIVATED,
+                                                   **values)
+    signup = getattr(instance, '_lutefisk_signup_cache', None)
+    if signup is not None:
+        for name, value in values.items():
+            setattr(signup, name, value)
+    instance._lutefisk_identification = identification
+
+def bump_profile(sender, instance, **kwargs):
+    """
+    Invalidates the cached profile pages of the user when their profile,
+    user or signup is saved or deleted.
+
+    """
+    if isinstance(instance, User):
+        bump_profile_version(instance.pk)
+    elif isinstance(instance, (LutefiskSignup, LutefiskBaseProfile)):
+        bump_profile_version(instance.user_id)
+
+post_save.connect(refresh_profile_language, dispatch_uid='lutefisk.refresh_profile_language')
+post_delete.connect(forget_profile_language, dispatch_uid='lutefisk.forget_profile_language')
+post_init.connect(remember_identification, sender=User, dispatch_uid='lutefisk.remember_identification')
+post_save.connect(sync_identification, sender=User, dispatch_uid='lutefisk.sync_identification')
+post_save.connect(forget_user, sender=User, dispatch_uid='lutefisk.forget_user_saved')
+post_delete.connect(forget_user, sender=User, dispatch_uid='lutefisk.forget_user_deleted')
+# Users from the cache of the authentication backend are instances of a
+# deferred subclass, which sends the signals with itself as sender.
+post_init.connect(remember_identification, sender=CachedUser, dispatch_uid='lutefisk.remember_identification_cached')
+post_save.connect(sync_identification, sender=CachedUser, dispatch_uid='lutefisk.sync_identification_cached')
+post_save.connect(forget_user, sender=CachedUser, dispatch_uid='lutefisk.forget_user_saved_cached')
+post_delete.connect(forget_user, sender=CachedUser, dispatch_uid='lutefisk.forget_user_deleted_cached')
+post_save.connect(bump_profile, dispatch_uid='lutefisk.bump_profile_saved')
+post_delete.connect(bump_profile, dispatch_uid='lutefisk.bump_profile_deleted')
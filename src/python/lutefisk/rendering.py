@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from django.conf import settings
+from django.template import Context, loader
+from django.utils import translation
+
+from lutefisk import instrumentation
+
+_templates = {}
+_lock = threading.Lock()
+
+
+def get_template(template_name):
+    """
+    Returns a compiled template, loading it only once per process and
+    language.
+
+    Set ``LUTEFISK_TEMPLATE_CACHE`` to ``False`` to load the template on
+    every call, e.g. while editing templates.
+
+    :param template_name:
+    String containing the name of the template.
+
+    """
+    if not settings.LUTEFISK_TEMPLATE_CACHE:
+        return loader.get_template(template_name)
+
+    key = (translation.get_language(), template_name)
+    template = _templates.get(key)
+    if template is None:
+        template = loader.get_template(template_name)
+        _lock.acquire()
+        try:
+            _templates[key] = template
+        finally:
+            _lock.release()
+    return template
+
+
+def render_to_string(template_name, dictionary=None):
+    """
+    Renders a template like Django's :func:`render_to_string` but with the
+    compiled template from :func:`get_template`.
+
+    """
+    with instrumentation.timer('template'):
+        return get_template(template_name).render(Context(dictionary or {}))
+
+
+def render_many(template_name, contexts, languages=None):
+    """
+    Renders a template for many contexts.
+
+    The contexts are grouped by language so that each language is
+    activated only once.
+
+    :param template_name:
+    String containing the name of the template.
+
+    :param contexts:
+    List of context dictionaries.
+
+    :param languages:
+    Optional list with the language of every context. The current language
+    is used for all contexts by default.
+
+    :return: List of rendered strings in the order of ``contexts``.
+
+    """
+    if languages is None:
+        languages = [None] * len(contexts)
+
+    groups = {}
+    for index, language in enumerate(languages):
+        groups.setdefault(language, []).append(index)
+
+    rendered = [None] * len(contexts)
+    current = translation.get_language()
+    try:
+        with instrumentation.timer('template'):
+            for language, indexes in groups.items():
+                if language is not None:
+                    translation.activate(language)
+                template = get_template(template_name)
+                for index in indexes:
+                    rendered[index] = template.render(Context(contexts[index]))
+                translation.activate(current)
+    finally:
+        translation.activate(current)
+    return rendered
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import DEFAULT_DB_ALIAS
+
+STICKY_SESSION_KEY = '_lutefisk_primary_until'
+
+_state = threading.local()
+
+
+def reset(**kwargs):
+    """
+    Forgets the reads and writes of the current thread. Called when a
+    request has finished.
+
+    """
+    _state.replica = 0
+    _state.sticky = False
+    _state.wrote = None
+
+
+def get_replica():
+    """
+    Returns the alias of a read replica for a lutefisk lookup.
+
+    Returns ``None``, which means the primary, when no replicas are
+    configured in ``LUTEFISK_READ_REPLICAS``, for
+    ``LUTEFISK_REPLICA_STICKY_SECONDS`` after the current thread wrote
+    anything, and during the sticky window of the session.
+
+    """
+    replicas = settings.LUTEFISK_READ_REPLICAS
+    if not replicas or getattr(_state, 'sticky', False):
+        return None
+    wrote = getattr(_state, 'wrote', None)
+    if wrote is not None and time.time() - wrote < settings.LUTEFISK_REPLICA_STICKY_SECONDS:
+        return None
+    return random.choice(replicas)
+
+
+class replica(object):
+    """
+    Context manager that sends the reads of lutefisk lookups to a
+    replica, as decided by :func:`get_replica`.
+
+    Only reads executed inside the block are routed. Lazy querysets that
+    are evaluated later should be bound with ``using(get_replica())``
+    instead.
+
+    """
+    def __enter__(self):
+        _state.replica = getattr(_state, 'replica', 0) + 1
+        return self
+
+    def __exit__(self, *args):
+        _state.replica -= 1
+
+
+class primary(object):
+    """
+    Context manager that keeps the reads inside the block on the primary,
+    also within a :class:`replica` block.
+
+    Used for reads that fill long-lived caches, which a lagging replica
+    would fill with data that was just invalidated.
+
+    """
+    def __enter__(self):
+        self.replica = getattr(_state, 'replica', 0)
+        _state.replica = 0
+        return self
+
+    def __exit__(self, *args):
+        _state.replica = self.replica
+
+
+class LutefiskReplicaRouter(object):
+    """
+    Database router that sends lutefisk's read-only lookups to the read
+    replicas in ``LUTEFISK_READ_REPLICAS`` and everything else to the
+    primary.
+
+    Add it to ``DATABASE_ROUTERS``. Reads are only routed inside a
+    :class:`replica` block. Every write marks the thread, so that later
+    reads of the same request see it. With
+    :class:`LutefiskReplicaMiddleware` the session stays on the primary
+    for ``LUTEFISK_REPLICA_STICKY_SECONDS`` after a write as well.
+
+    Two local SQLite databases can be used for testing, with the replica
+    set to ``TEST_MIRROR`` the primary, see ``lutefisk.tests.test_routers``.
+
+    """
+    def db_for_read(self, model, **hints):
+        if getattr(_state, 'replica', 0):
+            return get_replica()
+        return None
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = time.time()
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in settings.LUTEFISK_READ_REPLICAS:
+            # Instances read from a replica are written to the primary.
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = set(settings.LUTEFISK_READ_REPLICAS)
+        databases.add(DEFAULT_DB_ALIAS)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if db in settings.LUTEFISK_READ_REPLICAS:
+            return False
+        return None
+
+
+class LutefiskReplicaMiddleware(object):
+    """
+    Keep a session on the primary database for
+    ``LUTEFISK_REPLICA_STICKY_SECONDS`` after it wrote anything, so that
+    flows like signup followed by a profile view never read stale data.
+
+    Must be placed after ``SessionMiddleware``.
+
+    """
+    def process_request(self, request):
+        reset()
+        session = getattr(request, 'session', None)
+        if session is not None and session.get(STICKY_SESSION_KEY, 0) > time.time():
+            _state.sticky = True
+
+    def process_response(self, request, response):
+        session = getattr(request, 'session', None)
+        if session is not None and getattr(_state, 'wrote', None) is not None:
+            session[STICKY_SESSION_KEY] = time.time() + settings.LUTEFISK_REPLICA_STICKY_SECONDS
+        reset()
+        return response
+
+request_finished.connect(reset, dispatch_uid='lutefisk.routers.reset')
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
@@ -4,3 +4,6 @@ signup_complete = Signal(providing_args=["user",])
 activation_complete = Signal(providing_args=["user",])
 confirmation_complete = Signal(providing_args=["user","old_email"])
 password_complete = Signal(providing_args=["user",])
+password_checked = Signal(providing_args=["user","valid"])
+instrumentation_report = Signal(providing_args=["report",])
+request_throttled = Signal(providing_args=["request","action","identification"])
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+from django import template
+
+from lutefisk.fragments import get_profile_fragment
+
+register = template.Library()
+
+
+class ProfileFragmentNode(template.Node):
+    def __init__(self, nodelist, name, user_id):
+        self.nodelist = nodelist
+        self.name = name
+        self.user_id = template.Variable(user_id)
+
+    def render(self, context):
+        try:
+            user_id = self.user_id.resolve(context)
+        except template.VariableDoesNotExist:
+            raise template.TemplateSyntaxError('"profilefragment" tag got an unknown variable: %r' % self.user_id.var)
+        return get_profile_fragment(self.name, user_id,
+                                    lambda: self.nodelist.render(context))
+
+
+@register.tag('profilefragment')
+def do_profilefragment(parser, token):
+    """
+    Caches the contents of the block under the version of a user's
+    profile, so it is rendered again only after the profile, the user or
+    the signup changed. See :func:`get_profile_fragment`.
+
+    Usage::
+
+        {% load lutefisk_tags %}
+        {% profilefragment detail profile.user_id %}
+            .. profile contents ..
+        {% endprofilefragment %}
+
+    """
+    nodelist = parser.parse(('endprofilefragment',))
+    parser.delete_first_token()
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError('"%r" tag takes a fragment name and a user id.' % bits[0])
+    return ProfileFragmentNode(nodelist, bits[1], bits[2])
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
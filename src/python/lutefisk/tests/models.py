@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+from django.contrib.auth.models import User
+from django.db import models
+
+from lutefisk.models import LutefiskLanguageBaseProfile
+
+
+class Profile(LutefiskLanguageBaseProfile):
+    """ Profile model used by the tests and benchmarks. """
+    user = models.OneToOneField(User, unique=True, related_name='profile')
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
@@ -12,11 +12,36 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.environ['LUTEFISK_DB'] + os.sep + 'tests.db',
-        }
+        },
+    # A second connection to the same database that stands in for a read
+    # replica in the router tests.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['LUTEFISK_DB'] + os.sep + 'tests.db',
+        'TEST_MIRROR': 'default',
+        },
     }
 
 ROOT_URLCONF = 'lutefisk.tests.urls'
 
+INSTALLED_APPS = INSTALLED_APPS + (
+    'lutefisk.tests',
+    )
+
+AUTH_PROFILE_MODULE = 'tests.Profile'
+
+AUTHENTICATION_BACKENDS = (
+    'lutefisk.backends.LutefiskAuthenticationBackend',
+    'django.contrib.auth.backends.ModelBackend',
+    )
+
+MIDDLEWARE_CLASSES = MIDDLEWARE_CLASSES + (
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+    )
+
+SITE_ID = 1
+
 EMAIL_HOST = 'localhost'
 EMAIL_PORT = random.randint(1025, 9999)
 
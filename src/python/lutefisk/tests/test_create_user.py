@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, reset_queries
+
+from lutefisk.benchmarks import QUERY_BUDGETS
+from lutefisk.models import LutefiskMail, LutefiskSignup
+
+
+class CreateUserQueriesTestCase(unittest.TestCase):
+    """
+    Locks in the statements of :meth:`LutefiskManager.create_user`, the
+    ``create_user`` entry of ``QUERY_BUDGETS``.
+
+    """
+    def setUp(self):
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        reset_queries()
+
+    def tearDown(self):
+        connection.use_debug_cursor = self.use_debug_cursor
+        reset_queries()
+        User.objects.filter(username='queries').delete()
+
+    def test_create_user(self):
+        LutefiskSignup.objects.create_user('queries', 'queries@example.com', 'password',
+                                           send_email=False)
+        # The statement and the first quoted name, its table.
+        statements = [(query['sql'].split()[0], query['sql'].split('"')[1])
+                      for query in connection.queries]
+        self.assertEqual(statements, [('INSERT', 'auth_user'),
+                                      ('INSERT', 'lutefisk_lutefisksignup'),
+                                      ('SELECT', 'tests_profile'),
+                                      ('INSERT', 'tests_profile')])
+        self.assertEqual(len(statements), QUERY_BUDGETS['create_user'])
+
+
+class CreateUserOutboxTestCase(unittest.TestCase):
+    """
+    Tests that :meth:`LutefiskManager.create_user` stores the activation
+    email in the outbox in the same transaction as the account.
+
+    """
+    def setUp(self):
+        self.outbox = settings.LUTEFISK_EMAIL_OUTBOX
+        settings.LUTEFISK_EMAIL_OUTBOX = True
+        self.enqueue = LutefiskMail.objects.enqueue
+
+    def tearDown(self):
+        LutefiskMail.objects.enqueue = self.enqueue
+        settings.LUTEFISK_EMAIL_OUTBOX = self.outbox
+        User.objects.filter(username='outbox').delete()
+        LutefiskMail.objects.filter(recipients='outbox@example.com').delete()
+
+    def test_email_queued(self):
+        LutefiskSignup.objects.create_user('outbox', 'outbox@example.com', 'password')
+        self.assertEqual(LutefiskMail.objects.filter(recipients='outbox@example.com').count(), 1)
+
+    def test_rolled_back_with_email(self):
+        def enqueue(*args, **kwargs):
+            raise RuntimeError('outbox unavailable')
+        LutefiskMail.objects.enqueue = enqueue
+        self.assertRaises(RuntimeError, LutefiskSignup.objects.create_user,
+                          'outbox', 'outbox@example.com', 'password')
+        self.assertFalse(User.objects.filter(username='outbox').exists())
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.signals import request_finished
+from django.db import router as django_router
+from django.http import HttpRequest, HttpResponse
+
+from lutefisk import routers
+from lutefisk.backends import LutefiskAuthenticationBackend
+
+
+class RouterTestCase(unittest.TestCase):
+    """
+    Tests :class:`LutefiskReplicaRouter` with the ``replica`` connection of
+    the test settings, a second connection to the test database.
+
+    """
+    def setUp(self):
+        self.settings = (settings.LUTEFISK_READ_REPLICAS,
+                         settings.LUTEFISK_REPLICA_STICKY_SECONDS,
+                         settings.LUTEFISK_USER_CACHE)
+        settings.LUTEFISK_READ_REPLICAS = ('replica',)
+        settings.LUTEFISK_REPLICA_STICKY_SECONDS = 10
+        self.router = routers.LutefiskReplicaRouter()
+        django_router.routers.insert(0, self.router)
+        self.user = User.objects.create_user('router', 'router@example.com', 'password')
+        routers.reset()
+
+    def tearDown(self):
+        routers.reset()
+        self.user.delete()
+        django_router.routers.remove(self.router)
+        (settings.LUTEFISK_READ_REPLICAS,
+         settings.LUTEFISK_REPLICA_STICKY_SECONDS,
+         settings.LUTEFISK_USER_CACHE) = self.settings
+
+    def test_reads_outside_replica_block(self):
+        self.assertEqual(self.router.db_for_read(User), None)
+        self.assertEqual(User.objects.get(pk=self.user.pk)._state.db, 'default')
+
+    def test_reads_inside_replica_block(self):
+        with routers.replica():
+            self.assertEqual(self.router.db_for_read(User), 'replica')
+            user = User.objects.get(pk=self.user.pk)
+        self.assertEqual(user._state.db, 'replica')
+
+    def test_without_replicas(self):
+        settings.LUTEFISK_READ_REPLICAS = ()
+        with routers.replica():
+            self.assertEqual(self.router.db_for_read(User), None)
+
+    def test_primary_block(self):
+        with routers.replica():
+            with routers.primary():
+                self.assertEqual(User.objects.get(pk=self.user.pk)._state.db, 'default')
+            self.assertEqual(self.router.db_for_read(User), 'replica')
+
+    def test_writes_go_to_primary(self):
+        with routers.replica():
+            user = User.objects.get(pk=self.user.pk)
+        self.assertEqual(self.router.db_for_write(User, instance=user), 'default')
+        user.first_name = 'Router'
+        user.save()
+        self.assertEqual(user._state.db, 'default')
+
+    def test_reads_after_write(self):
+        self.user.save()
+        with routers.replica():
+            self.assertEqual(self.router.db_for_read(User), None)
+
+        # The thread reads from the replica again after the sticky window.
+        routers._state.wrote = time.time() - settings.LUTEFISK_REPLICA_STICKY_SECONDS
+        with routers.replica():
+            self.assertEqual(self.router.db_for_read(User), 'replica')
+
+    def test_reset_at_request_finished(self):
+        self.user.save()
+        request_finished.send(sender=self.__class__)
+        with routers.replica():
+            self.assertEqual(self.router.db_for_read(User), 'replica')
+
+    def test_sticky_session(self):
+        middleware = routers.LutefiskReplicaMiddleware()
+        request = HttpRequest()
+        request.session = SessionStore()
+
+        middleware.process_request(request)
+        self.user.save()
+        middleware.process_response(request, HttpResponse())
+        self.assertTrue(routers.STICKY_SESSION_KEY in request.session)
+
+        middleware.process_request(request)
+        with routers.replica():
+            self.assertEqual(self.router.db_for_read(User), None)
+        middleware.process_response(request, HttpResponse())
+
+        request.session[routers.STICKY_SESSION_KEY] = time.time() - 1
+        middleware.process_request(request)
+        with routers.replica():
+            self.assertEqual(self.router.db_for_read(User), 'replica')
+
+    def test_user_cache_filled_from_primary(self):
+        settings.LUTEFISK_USER_CACHE = True
+        backend = LutefiskAuthenticationBackend()
+        self.assertEqual(backend.get_user(self.user.pk)._state.db, 'default')
+
+        settings.LUTEFISK_USER_CACHE = False
+        self.assertEqual(backend.get_user(self.user.pk)._state.db, 'replica')
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
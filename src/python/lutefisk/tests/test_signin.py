@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+
+from lutefisk import signals
+from lutefisk.backends import LutefiskAuthenticationBackend
+from lutefisk.benchmarks import HASH_BUDGETS
+from lutefisk.models import LutefiskSignup
+
+
+class SigninHashesTestCase(unittest.TestCase):
+    """
+    Locks in one password hash per sign in, the ``signin`` entry of
+    ``HASH_BUDGETS``.
+
+    """
+    def setUp(self):
+        self.user = LutefiskSignup.objects.create_user('hashes', 'hashes@example.com',
+                                                       'password', active=True,
+                                                       send_email=False)
+        self.hashes = []
+        signals.password_checked.connect(self.count_hash)
+
+        self.authentications = []
+        self.authenticate = LutefiskAuthenticationBackend.authenticate
+        def authenticate(backend, *args, **kwargs):
+            self.authentications.append(kwargs.get('identification'))
+            return self.authenticate(backend, *args, **kwargs)
+        LutefiskAuthenticationBackend.authenticate = authenticate
+
+    def tearDown(self):
+        LutefiskAuthenticationBackend.authenticate = self.authenticate
+        signals.password_checked.disconnect(self.count_hash)
+        User.objects.filter(pk=self.user.pk).delete()
+
+    def count_hash(self, sender, **kwargs):
+        self.hashes.append(kwargs['valid'])
+
+    def test_signin(self):
+        response = Client().post(reverse('lutefisk_signin'),
+                                 {'identification': 'hashes@example.com',
+                                  'password': 'password'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.hashes, [True])
+        self.assertEqual(len(self.hashes), HASH_BUDGETS['signin'])
+        self.assertEqual(self.authentications, ['hashes@example.com'])
+
+    def test_wrong_password(self):
+        response = Client().post(reverse('lutefisk_signin'),
+                                 {'identification': 'hashes@example.com',
+                                  'password': 'wrong'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.hashes, [False])
+        self.assertEqual(self.authentications, ['hashes@example.com'])
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.hashcompat import md5_constructor
+
+from lutefisk import signals
+from lutefisk.utils import normalize_identification
+
+_stats = {}
+_stats_lock = threading.Lock()
+_store = None
+
+
+class LocalStore(object):
+    """
+    Keeps the throttle counters in the memory of the current process.
+
+    """
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.pruned = 0
+
+    def incr(self, key, timeout):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if now - self.pruned > 60:
+                self.counts = dict((k, v) for k, v in self.counts.items() if v[1] > now)
+                self.pruned = now
+            count, expires = self.counts.get(key, (0, 0))
+            if expires <= now:
+                count = 0
+            self.counts[key] = (count + 1, now + timeout)
+            return count + 1
+        finally:
+            self.lock.release()
+
+    def get(self, key):
+        count, expires = self.counts.get(key, (0, 0))
+        if expires <= time.time():
+            return 0
+        return count
+
+
+class CacheStore(object):
+    """
+    Keeps the throttle counters in the Django cache, so that they are
+    shared by all processes using the same cache backend.
+
+    """
+    def incr(self, key, timeout):
+        cache.add(key, 0, timeout)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # The counter expired between add and incr.
+            cache.set(key, 1, timeout)
+            return 1
+
+    def get(self, key):
+        return cache.get(key, 0)
+
+
+def get_store():
+    """
+    Returns the store selected with ``LUTEFISK_THROTTLE_STORE``, which is
+    either ``local`` or ``cache``.
+
+    """
+    global _store
+    if _store is None:
+        stores = {'local': LocalStore, 'cache': CacheStore}
+        try:
+            _store = stores[settings.LUTEFISK_THROTTLE_STORE]()
+        except KeyError:
+            raise ImproperlyConfigured('LUTEFISK_THROTTLE_STORE must be one of %s.' %
+                                       ', '.join(sorted(stores)))
+    return _store
+
+
+def parse_rate(rate):
+    """
+    Parses a rate like ``10/300``.
+
+    :return: Tuple containing the number of allowed hits and the window in
+    seconds.
+
+    """
+    limit, window = rate.split('/')
+    return int(limit), int(window)
+
+
+class Throttle(object):
+    """
+    Sliding window counter for one throttle rule.
+
+    The window is approximated with two fixed windows: the count of the
+    previous window is weighed by the part of it that still overlaps the
+    sliding window, which needs two counters per key instead of a list
+    of timestamps.
+
+    """
+    def __init__(self, name, rate, store=None):
+        self.name = name
+        self.limit, self.window = parse_rate(rate)
+        self.store = store or get_store()
+
+    def get_keys(self, value, now):
+        digest = md5_constructor(value.encode('utf-8')).hexdigest()
+        current = int(now // self.window)
+        return ['lutefisk:throttle:%s:%s:%s' % (self.name, digest, window)
+                for window in (current, current - 1)]
+
+    def estimate(self, current, previous, now):
+        elapsed = (now % self.window) / float(self.window)
+        return current + previous * (1 - elapsed)
+
+    def hit(self, value):
+        """
+        Counts a hit for ``value``.
+
+        :return: ``True`` if ``value`` exceeded the limit.
+
+        """
+        now = time.time()
+        current_key, previous_key = self.get_keys(value, now)
+        current = self.store.incr(current_key, self.window * 2)
+        previous = self.store.get(previous_key)
+        return self.estimate(current, previous, now) > self.limit
+
+    def count(self, value):
+        """ Returns the current number of hits for ``value``. """
+        now = time.time()
+        current_key, previous_key = self.get_keys(value, now)
+        return self.estimate(self.store.get(current_key), self.store.get(previous_key), now)
+
+
+def get_throttle(name):
+    """
+    Returns the :class:`Throttle` for the rule ``name`` from
+    ``LUTEFISK_THROTTLE_RATES`` or ``None`` if it has no rate.
+
+    """
+    rate = settings.LUTEFISK_THROTTLE_RATES.get(name)
+    if not rate:
+        return None
+    return Throttle(name, rate)
+
+
+def _record(name, rejected):
+    _stats_lock.acquire()
+    try:
+        stats = _stats.setdefault(name, {'checked': 0, 'rejected': 0})
+        stats['checked'] += 1
+        if rejected:
+            stats['rejected'] += 1
+    finally:
+        _stats_lock.release()
+
+
+def get_stats():
+    """
+    Returns the number of ``checked`` and ``rejected`` requests per rule
+    since the process started.
+
+    """
+    _stats_lock.acquire()
+    try:
+        return dict((name, dict(stats)) for name, stats in _stats.items())
+    finally:
+        _stats_lock.release()
+
+
+def get_client_ip(request):
+    """
+    Returns the address of the client from the ``request.META`` key named
+    by ``LUTEFISK_THROTTLE_IP_META``.
+
+    """
+    return request.META.get(settings.LUTEFISK_THROTTLE_IP_META, '') or ''
+
+
+def is_throttled(request, action, identification=None):
+    """
+    Counts an attempt of ``action`` and checks the ``<action>_ip`` and
+    ``<action>_identification`` rules of ``LUTEFISK_THROTTLE_RATES``.
+
+    Sends the ``request_throttled`` signal when the request must be
+    rejected.
+
+    :param request:
+    The current :class:`HttpRequest`.
+
+    :param action:
+    String like ``signin``, ``signup`` or ``password_reset``.
+
+    :param identification:
+    Optional email or username the request is about.
+
+    :return: The seconds to wait before retrying or ``None`` if the request
+    is allowed.
+
+    """
+    if not settings.LUTEFISK_THROTTLE:
+        return None
+
+    checks = [('%s_ip' % action, get_client_ip(request))]
+    identification = normalize_identification(identification)
+    if identification:
+        checks.append(('%s_identification' % action, identification))
+
+    retry_after = None
+    for name, value in checks:
+        throttle = get_throttle(name)
+        if throttle is None:
+            continue
+        rejected = throttle.hit(value)
+        _record(name, rejected)
+        if rejected:
+            retry_after = max(retry_after, throttle.window)
+
+    if retry_after is not None:
+        signals.request_throttled.send(sender=None, request=request, action=action,
+                                       identification=identification)
+    return retry_after
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
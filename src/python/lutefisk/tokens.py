@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import int_to_base36, base36_to_int
+
+from lutefisk.utils import get_datetime_now
+
+
+def get_timestamp(dt):
+    """
+    Returns the number of seconds since the epoch of a datetime.
+
+    The datetime is read as UTC, not as local time, so the timestamp of a
+    stored datetime is the same on every host regardless of its time zone
+    and daylight saving time.
+
+    """
+    return calendar.timegm(dt.utctimetuple())
+
+
+class LutefiskTokenGenerator(object):
+    """
+    Strategy object used to generate and check signed activation and email
+    confirmation tokens.
+
+    A token contains the user id and the moment the key was issued, signed
+    with ``SECRET_KEY`` for a single purpose. Tampered and expired tokens
+    are rejected without touching the database. The issue timestamp is
+    compared with the stored ``date_joined`` or
+    ``email_confirmation_key_created`` afterwards, so a token stops working
+    once a newer one has been issued.
+
+    """
+    key_salt = 'lutefisk.tokens.LutefiskTokenGenerator'
+
+    def make_token(self, user_id, purpose, issued):
+        """
+        Returns a token for ``purpose`` that was issued at ``issued``.
+
+        :param user_id:
+        The primary key of the :class:`User`.
+
+        :param purpose:
+        String like ``activation`` or ``confirmation``.
+
+        :param issued:
+        Datetime the token was issued.
+
+        """
+        return self._make_token_with_timestamp(user_id, purpose, get_timestamp(issued))
+
+    def check_token(self, token, purpose, days):
+        """
+        Checks the signature and age of a token.
+
+        :param token:
+        String containing the token.
+
+        :param purpose:
+        String with the purpose the token must have been made for.
+
+        :param days:
+        Integer with the number of days the token is valid.
+
+        :return:
+        Tuple containing the user id and the issue timestamp or ``None``
+        when the token is invalid or expired.
+
+        """
+        try:
+            uid_b36, ts_b36, hash = token.split('-')
+            user_id, timestamp = base36_to_int(uid_b36), base36_to_int(ts_b36)
+        except ValueError:
+            return None
+
+        if not constant_time_compare(self._make_token_with_timestamp(user_id, purpose, timestamp), token):
+            return None
+
+        if get_timestamp(get_datetime_now()) >= timestamp + days * 86400:
+            return None
+
+        return user_id, timestamp
+
+    def _make_token_with_timestamp(self, user_id, purpose, timestamp):
+        value = u'%s-%s-%s' % (purpose, user_id, timestamp)
+        hash = salted_hmac(self.key_salt, value).hexdigest()[::2]
+        return '%s-%s-%s' % (int_to_base36(user_id), int_to_base36(timestamp), hash)
+
+default_token_generator = LutefiskTokenGenerator()
+
+# Local Variables:
+# indent-tabs-mode: nil
+# End:
+# vim: ai et sw=4 ts=4
@@ -25,6 +25,9 @@ urlpatterns = patterns('',
                            name='lutefisk_password_reset_confirm'),
 
                        # Activate
+                       url(r'^activate/(?P<token>[0-9a-z]+-[0-9a-z]+-[0-9a-f]+)/$',
+                           lutefisk_views.activate,
+                           name='lutefisk_activate_token'),
                        url(r'^activate/(?P<username>[\.\w]+)/(?P<activation_key>\w+)/$',
                            lutefisk_views.activate,
                            name='lutefisk_activate'),
@@ -33,6 +36,9 @@ urlpatterns = patterns('',
                        url(r'^change-email/$',
                            lutefisk_views.email_change,
                            name='lutefisk_email_change'),
+                       url(r'^change-email/(?P<token>[0-9a-z]+-[0-9a-z]+-[0-9a-f]+)/$',
+                           lutefisk_views.email_change_confirm,
+                           name='lutefisk_email_change_confirm_token'),
                        url(r'^change-email/(?P<confirmation_key>\w+)/$',
                            lutefisk_views.email_change_confirm,
                            name='lutefisk_email_change_confirm'),
@@ -47,6 +53,19 @@ urlpatterns = patterns('',
                            lutefisk_views.profile_edit,
                            name='lutefisk_profile_edit'),
 
+                       # Profile directory
+                       url(r'^profiles/$',
+                           lutefisk_views.profile_list,
+                           name='lutefisk_profile_list'),
+                       url(r'^profiles/api/$',
+                           lutefisk_views.profile_list_api,
+                           name='lutefisk_profile_list_api'),
+
+                       # Email availability
+                       url(r'^email/available/$',
+                           lutefisk_views.email_available,
+                           name='lutefisk_email_available'),
+
                        # View profiles
                        url(r'^$',
                            lutefisk_views.profile_detail,
@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import inspect
+import os
 import random
+import time
 import urllib
 
 from django.conf import settings
 from django.contrib.auth.models import SiteProfileNotAvailable, User
 from django.contrib.auth.tokens import default_token_generator
-from django.db.models import get_model
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections, router, transaction
+from django.db.models import AutoField, Model, get_model, signals
+from django.db.models.query import QuerySet
+from django.db.models.query_utils import deferred_class_factory
 from django.utils.hashcompat import md5_constructor
 from django.utils.hashcompat import sha_constructor
 from django.utils.http import base36_to_int
@@ -60,6 +68,144 @@ def generate_sha1(string, salt=None):
     return (salt, sha_constructor(salt+str(string)).hexdigest())
 
 
+def generate_key():
+    """
+    Generates a random key in the same format as :func:`generate_sha1`.
+
+    Uses ``os.urandom`` instead of :func:`random.random` so that keys can
+    be generated in bulk without hashing a username for each of them.
+
+    :return: String containing 40 hexadecimal characters.
+
+    """
+    return os.urandom(20).encode('hex')
+
+
+def bulk_insert(model, objs, using=None):
+    """
+    Inserts a list of model instances.
+
+    Uses ``QuerySet.bulk_create`` when the installed Django provides it and
+    a single ``executemany`` otherwise. ``save()`` isn't called, no signals
+    are sent and the primary keys of the instances are not set.
+
+    :param model:
+    The model class of the instances.
+
+    :param objs:
+    List of unsaved model instances.
+
+    """
+    using = using or router.db_for_write(model)
+    if hasattr(QuerySet, 'bulk_create'):
+        model._default_manager.db_manager(using).bulk_create(objs)
+        return
+    if not objs:
+        return
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = [field for field in model._meta.local_fields if not isinstance(field, AutoField)]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
+        (qn(model._meta.db_table),
+         ', '.join(qn(field.column) for field in fields),
+         ', '.join(['%s'] * len(fields)))
+    rows = [[field.get_db_prep_save(field.pre_save(obj, True), connection=connection)
+             for field in fields]
+            for obj in objs]
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed(using=using)
+
+
+def update_fields(instance, fields, using=None):
+    """
+    Writes only ``fields`` of a saved model instance.
+
+    Uses ``save(update_fields=...)`` when the installed Django provides it
+    and falls back to an ``UPDATE`` of those columns otherwise. The
+    fallback sends ``pre_save`` and ``post_save`` like ``save()``, so cache
+    invalidating receivers keep working.
+
+    :param instance:
+    The model instance that was changed.
+
+    :param fields:
+    List with the names of the changed fields.
+
+    """
+    model = instance.__class__
+    using = using or instance._state.db or 'default'
+    if 'update_fields' in inspect.getargspec(Model.save)[0]:
+        instance.save(update_fields=fields, using=using)
+        return
+
+    signals.pre_save.send(sender=model, instance=instance, raw=False, using=using)
+    values = dict((name, getattr(instance, model._meta.get_field(name).attname))
+                  for name in fields)
+    model._default_manager.using(using).filter(pk=instance.pk).update(**values)
+    signals.post_save.send(sender=model, instance=instance, created=False,
+                           raw=False, using=using)
+
+
+def values_list_in(queryset, lookup, values, fields, flat=False, batch_size=500):
+    """
+    Returns the rows of ``queryset.filter(<lookup>__in=values)`` as
+    ``values_list(*fields)``. The values are queried in chunks of
+    ``batch_size``, so the number of query parameters stays below the
+    limits of the database, like the 999 variables of SQLite.
+
+    :param lookup:
+    String with the field lookup that is combined with ``__in``.
+
+    :param values:
+    The values to look up.
+
+    :param fields:
+    Tuple with the names of the returned fields.
+
+    :return: List of the rows, or of the values when ``flat`` is ``True``.
+
+    """
+    values = list(values)
+    rows = []
+    for start in range(0, len(values), batch_size):
+        rows.extend(queryset.filter(**{'%s__in' % lookup: values[start:start + batch_size]})
+                    .values_list(*fields, **{'flat': flat}))
+    return rows
+
+
+def normalize_email(email):
+    """
+    Normalizes an email address like ``UserManager.create_user`` by
+    removing surrounding whitespace and lower-casing the domain part.
+
+    :param email:
+    A string containing an email address.
+
+    """
+    email = email.strip()
+    try:
+        email_name, domain_part = email.split('@', 1)
+    except ValueError:
+        return email
+    return '@'.join([email_name, domain_part.lower()])
+
+
+def normalize_identification(identification):
+    """
+    Normalizes an email address or username for case-insensitive lookups.
+
+    :param identification:
+    A string containing an email address or username.
+
+    :return: The lower-cased string or ``None`` if it is empty.
+
+    """
+    if not identification:
+        return None
+    return identification.lower()
+
+
 def get_profile_model():
     """
     Return the model class for the currently-active user profile
@@ -77,6 +223,119 @@ def get_profile_model():
     return profile_mod
 
 
+def get_request_profile(request):
+    """
+    Returns the profile of the signed in user of a request.
+
+    The profile, its user and the user's :class:`LutefiskSignup` are
+    fetched with a single query and memoized on the request. The related
+    objects are cached on ``request.user`` as well, so that
+    ``request.user.get_profile()``, ``profile.user`` and
+    ``request.user.lutefisk_signup`` don't query the database again.
+
+    :param request:
+    The :class:`HttpRequest` of a signed in user.
+
+    :return: The profile of ``request.user``. A missing signup is not an
+    error, ``request.user.lutefisk_signup`` then raises ``DoesNotExist``
+    as usual.
+
+    """
+    profile = getattr(request, '_lutefisk_profile', None)
+    if profile is None:
+        user = request.user
+        profile = get_profile_model().objects.select_related('user__lutefisk_signup') \
+            .get(user=user.pk)
+        # Users created before lutefisk was installed may have no signup.
+        # Depending on the Django version select_related then gives None or
+        # raises DoesNotExist.
+        try:
+            signup = profile.user.lutefisk_signup
+        except ObjectDoesNotExist:
+            signup = None
+        if signup is not None:
+            user._lutefisk_signup_cache = signup
+        user._profile_cache = profile
+        profile._user_cache = user
+        request._lutefisk_profile = profile
+    return profile
+
+
+def get_language_cache_key(user_id):
+    """
+    Returns the cache key of the profile language of a user.
+
+    :param user_id:
+    The primary key of the :class:`User`.
+
+    """
+    return 'lutefisk:language:%s' % user_id
+
+
+# The users cached by the authentication backend have no password. It is
+# loaded from the database when it is used, e.g. to change it.
+CachedUser = deferred_class_factory(User, ['password'])
+
+
+def get_user_version_key(user_id):
+    return 'lutefisk:user-version:%s' % user_id
+
+
+def get_user_version(user_id):
+    """
+    Returns the current version of a user cached by the authentication
+    backend.
+
+    A missing version starts at the current time in microseconds, like
+    :func:`get_profile_version`.
+
+    :param user_id:
+    The primary key of the :class:`User`.
+
+    """
+    key = get_user_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000000), settings.LUTEFISK_USER_CACHE_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def get_user_cache_key(user_id, version):
+    """
+    Returns the cache key of a user cached by the authentication backend.
+
+    :param user_id:
+    The primary key of the :class:`User`.
+
+    :param version:
+    The version from :func:`get_user_version`.
+
+    """
+    return 'lutefisk:user:%s:%s' % (user_id, version)
+
+
+def forget_cached_user(user_id):
+    """
+    Invalidates a user in the cache of the authentication backend by
+    incrementing its version.
+
+    Called whenever a user is saved or deleted. Call this after changing a
+    user with ``QuerySet.update``, which doesn't send the ``post_save``
+    signal.
+
+    :param user_id:
+    The primary key of the :class:`User`.
+
+    """
+    if settings.LUTEFISK_USER_CACHE:
+        try:
+            cache.incr(get_user_version_key(user_id))
+        except ValueError:
+            # No version yet, so nothing was cached.
+            pass
+
+
 def get_protocol():
     """
     Returns a string with the current protocol.
@@ -2,21 +2,42 @@
 
 from django.conf import settings
 from django.contrib import messages
-from django.contrib.auth import authenticate, login, logout, REDIRECT_FIELD_NAME
+from django.contrib.auth import login, logout, REDIRECT_FIELD_NAME
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseForbidden, Http404
+from django.core.validators import email_re
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, Http404
 from django.shortcuts import redirect, get_object_or_404
-from django.template.loader import render_to_string
+from django.utils import simplejson
 from django.utils.translation import ugettext as _
 from django.views.generic import list_detail
 from django.views.generic.simple import direct_to_template
 
+from lutefisk import dispatch
 from lutefisk import forms
+from lutefisk import fragments
 from lutefisk import models
+from lutefisk import routers
 from lutefisk import signals
+from lutefisk import throttling
 from lutefisk import utils
+from lutefisk.rendering import render_to_string
+
+
+def throttled(request, retry_after, template_name='lutefisk/throttled.html',
+              extra_context=None):
+    """
+    Returns the ``429 Too Many Requests`` response for a throttled request.
+
+    :param retry_after:
+    Integer with the seconds after which the client may try again.
+
+    """
+    response = direct_to_template(request, template_name, extra_context=extra_context)
+    response.status_code = 429
+    response['Retry-After'] = str(retry_after)
+    return response
 
 
 def signup(request, template_name='lutefisk/signup_form.html',
@@ -34,13 +55,21 @@ def signup(request, template_name='lutefisk/signup_form.html',
     else:
         data = None
 
+    if data is not None:
+        retry_after = throttling.is_throttled(request, 'signup', data.get('email'))
+        if retry_after is not None:
+            return throttled(request, retry_after)
+
     form = forms.SignupForm(data=data)
 
     if data is not None:
         if form.is_valid():
             user = form.save()
+        else:
+            user = None
 
-            signals.signup_complete.send(sender=None, user=user)
+        if user is not None:
+            dispatch.send(signals.signup_complete, user=user)
 
             if success_url:
                 redirect_to = success_url
@@ -63,7 +92,7 @@ def signup(request, template_name='lutefisk/signup_form.html',
     return direct_to_template(request, template_name, extra_context=extra_context)
 
 
-def activate(request, username, activation_key,
+def activate(request, username=None, activation_key=None, token=None,
              template_name='lutefisk/activate_fail.html',
              success_url=None, extra_context=None):
     """ TODO:
@@ -73,12 +102,17 @@ def activate(request, username, activation_key,
     if not extra_context:
         extra_context = dict()
 
-    user = models.LutefiskSignup.objects.activate_user(username, activation_key)
+    if token is not None:
+        user = models.LutefiskSignup.objects.activate_user_token(token)
+    else:
+        user = models.LutefiskSignup.objects.activate_user(username, activation_key)
 
     if not user:
         return direct_to_template(request, template_name, extra_context=extra_context)
 
-    user = authenticate(identification=user.email, check_password=False)
+    # The user was loaded by the activation, so it is logged in directly
+    # instead of being looked up again by authenticate.
+    user.backend = 'lutefisk.backends.LutefiskAuthenticationBackend'
     login(request, user)
 
     if success_url:
@@ -106,14 +140,17 @@ def signout(request, message_template_name='lutefisk/signout_message.html',
 
 
 @login_required
-def email_change_confirm(request, confirmation_key,
+def email_change_confirm(request, confirmation_key=None, token=None,
                          message_template_name='lutefisk/email_change_confirm_message.html',
                          success_url=None, extra_context=None):
     """ TODO:
 
     """
 
-    user = models.LutefiskSignup.objects.confirm_email(request.user.username, confirmation_key)
+    if token is not None:
+        user = models.LutefiskSignup.objects.confirm_email_token(request.user.pk, token)
+    else:
+        user = models.LutefiskSignup.objects.confirm_email(request.user.username, confirmation_key)
 
     if not user:
         raise Http404()
@@ -151,6 +188,11 @@ def password_reset(request, template_name='lutefisk/password_reset_form.html',
     else:
         data = None
 
+    if data is not None:
+        retry_after = throttling.is_throttled(request, 'password_reset', data.get('email'))
+        if retry_after is not None:
+            return throttled(request, retry_after)
+
     form = forms.PasswordResetForm(data=data)
 
     if data is not None:
@@ -235,14 +277,16 @@ def signin(request, template_name='lutefisk/signin_form.html',
     else:
         data = None
 
+    if data is not None:
+        retry_after = throttling.is_throttled(request, 'signin', data.get('identification'))
+        if retry_after is not None:
+            return throttled(request, retry_after)
+
     form = forms.AuthenticationForm(data=data)
 
     if data is not None:
         if form.is_valid():
-            identification = form.cleaned_data['identification']
-            password = form.cleaned_data['password']
-
-            user = authenticate(identification=identification, password=password)
+            user = form.get_user()
 
             if user.is_active:
                 login(request, user)
@@ -280,7 +324,7 @@ def email_change(request, template_name='lutefisk/email_change_form.html',
     """
 
     user = request.user
-    profile = user.get_profile()
+    profile = utils.get_request_profile(request)
 
     if not extra_context:
         extra_context = dict()
@@ -324,7 +368,7 @@ def password_change(request, template_name='lutefisk/password_change_form.html',
     """
 
     user = request.user
-    profile = user.get_profile()
+    profile = utils.get_request_profile(request)
 
     if not extra_context:
         extra_context = dict()
@@ -340,7 +384,7 @@ def password_change(request, template_name='lutefisk/password_change_form.html',
         if form.is_valid():
             form.save()
 
-            signals.password_complete.send(sender=None, user=user)
+            dispatch.send(signals.password_complete, user=user)
 
             messages.add_message(request, messages.SUCCESS,
                                  render_to_string(message_template_name, extra_context),
@@ -367,7 +411,10 @@ def profile_edit(request, template_name='lutefisk/profile_form.html',
     """
 
     user = request.user
-    profile = user.get_profile()
+    if request.method == 'POST':
+        profile = utils.get_request_profile(request)
+    else:
+        profile = fragments.get_cached_profile(request)
 
     if not extra_context:
         extra_context = dict()
@@ -409,7 +456,8 @@ def profile_detail(request, template_name='lutefisk/profile_detail.html',
     """
 
     user = request.user
-    profile = user.get_profile()
+    with routers.replica():
+        profile = fragments.get_cached_profile(request)
 
     if not extra_context:
         extra_context = dict()
@@ -418,6 +466,104 @@ def profile_detail(request, template_name='lutefisk/profile_detail.html',
 
     return direct_to_template(request, template_name, extra_context=extra_context, **kwargs)
 
+
+
+def get_profile_page(request):
+    """
+    Returns the page of visible profiles requested with the ``after``
+    parameter, together with the ``after`` value of the next page.
+
+    """
+    try:
+        after = int(request.GET['after'])
+    except (KeyError, ValueError):
+        after = None
+
+    profile_model = utils.get_profile_model()
+    return profile_model.objects.get_visible_profiles_page(request.user, after)
+
+
+def profile_list(request, template_name='lutefisk/profile_list.html',
+                 extra_context=None, **kwargs):
+    """
+    Lists the profiles that are visible to the user, one page at a time.
+
+    Pages are requested with the ``after`` parameter, see
+    :func:`get_visible_profiles_page`. The template gets the ``profiles``
+    of the page, the ``next_after`` value of the next page, which is
+    ``None`` on the last page, and the cached ``profile_count``.
+
+    :param template_name:
+    String containing the template to render. Defaults to
+    ``lutefisk/profile_list.html``.
+
+    :param extra_context:
+    Dictionary with extra variables for the template.
+
+    """
+
+    profiles, next_after = get_profile_page(request)
+
+    if not extra_context:
+        extra_context = dict()
+
+    profile_model = utils.get_profile_model()
+
+    extra_context['profiles'] = profiles
+    extra_context['next_after'] = next_after
+    extra_context['profile_count'] = profile_model.objects.count_visible_profiles(request.user)
+
+    return direct_to_template(request, template_name, extra_context=extra_context, **kwargs)
+
+
+def profile_list_api(request):
+    """
+    Returns a page of the profiles that are visible to the user as JSON.
+
+    The response contains the ``username`` and ``name`` of every profile,
+    the ``next`` value to pass as the ``after`` parameter for the next page
+    and the cached ``count`` of visible profiles. Email addresses are never
+    included.
+
+    """
+
+    profiles, next_after = get_profile_page(request)
+
+    profile_model = utils.get_profile_model()
+
+    # Email addresses are never exposed, even without usernames.
+    data = {'profiles': [{'username': profile.user.username,
+                          'name': profile.user.get_full_name()}
+                         for profile in profiles],
+            'next': next_after,
+            'count': profile_model.objects.count_visible_profiles(request.user)}
+
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')
+
+
+def email_available(request):
+    """
+    Returns as JSON whether the email address in the ``email`` parameter
+    can be used for a new account.
+
+    """
+    email = request.GET.get('email', '').strip()
+    if not email_re.search(email):
+        return HttpResponseBadRequest(simplejson.dumps({'error': 'invalid email'}),
+                                      mimetype='application/json')
+
+    retry_after = throttling.is_throttled(request, 'email_available')
+    if retry_after is not None:
+        response = HttpResponse(simplejson.dumps({'error': 'throttled'}),
+                                mimetype='application/json', status=429)
+        response['Retry-After'] = str(retry_after)
+        return response
+
+    data = {'email': email,
+            'available': models.LutefiskSignup.objects.is_email_available(email)}
+
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')
+
 # Local Variables:
 # indent-tabs-mode: nil
 # End: